@@ -3,6 +3,8 @@
 $PROJECT_ID = "visionlinktriage"
 $SERVICE_NAME = "visionlink"
 $REGION = "us-east4"
+# Requests per instance; ui_gradio.py reads the same value for its queue
+$CONCURRENCY = 80
 
 Write-Host "Deploying VisionLink to Cloud Run..." -ForegroundColor Cyan
 
@@ -40,7 +42,7 @@ if ($LASTEXITCODE -ne 0) {
     exit 1
 }
 
-gcloud run deploy $SERVICE_NAME --image $IMAGE_URL --region $REGION --allow-unauthenticated --project $PROJECT_ID --memory 16Gi --cpu 4 --gpu 1 --gpu-type nvidia-l4 --max-instances 1 --no-gpu-zonal-redundancy --timeout 3600 --set-env-vars HF_TOKEN=$HF_TOKEN --quiet
+gcloud run deploy $SERVICE_NAME --image $IMAGE_URL --region $REGION --allow-unauthenticated --project $PROJECT_ID --memory 16Gi --cpu 4 --gpu 1 --gpu-type nvidia-l4 --max-instances 1 --no-gpu-zonal-redundancy --timeout 3600 --concurrency $CONCURRENCY --set-env-vars HF_TOKEN=$HF_TOKEN,GRADIO_CONCURRENCY=$CONCURRENCY --quiet
 
 if ($LASTEXITCODE -ne 0) {
     Write-Host "Cloud Run deployment failed." -ForegroundColor Red
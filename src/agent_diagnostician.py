@@ -1,56 +1,241 @@
-from agent_investigator import load_medgemma_model
-from transformers import pipeline
+import re
+import threading
+from agent_investigator import get_pipe, run_pipeline, build_request, stream_pipeline
+from agent_investigator import render_prompt, prefix_cache_enabled, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+from batcher import MicroBatcher
+from model_residency import residency
+from prefix_cache import prefix_cache
+from exemplar_index import format_similar_cases
 
-# ...
+# Structured triage decision used by the orchestrator loop
+TRIAGE_LEVELS = ["RED", "YELLOW", "GREEN", "INSUFFICIENT"]
 
-def generate_referral(findings, history):
-    # ... (prompt def)
-    base_prompt = f"""You are a senior ophthalmologist. Review the visual findings: {findings} and the patient's history: {history}. 
-    
+# First-token ids of each level, per tokenizer (filled on first use)
+_level_token_ids = {}
+
+# Groups concurrent triage scoring passes into one padded forward pass
+scorer = None
+_scorer_lock = threading.Lock()
+
+TRIAGE_CRITERIA = """
     Determine the Triage Level based on these STRICT criteria:
     - **RED (EMERGENCY)**: Sudden vision loss (hours/days), eye pain, trauma, retinal detachment, or signs of severe proliferative retinopathy with active bleeding. Immediate referral required.
     - **YELLOW (URGENT)**: Distorted vision, macular edema, severe non-proliferative retinopathy, or gradual but significant vision decline. Specialist needed within 1-2 weeks.
     - **GREEN (ROUTINE)**: Mild/Moderate retinopathy, stable vision, routine screening, or normal findings. Routine follow-up.
+"""
 
+# Static instruction blocks come first so their KV cache can be reused (see prefix_cache.py)
+REFERRAL_INSTRUCTIONS = f"""You are a senior ophthalmologist. Review the visual findings and the patient's history below.
+    {TRIAGE_CRITERIA}
     Write a professional referral letter. 
     explicitly state the TRIAGE LEVEL at the top.
     Explain your reasoning for the chosen level.
     """
 
+TRIAGE_INSTRUCTIONS = f"""You are a senior ophthalmologist. Review the visual findings and the patient's history below.
+    {TRIAGE_CRITERIA}
+    If the history is not yet enough to decide between these levels, answer INSUFFICIENT.
+    Answer with exactly one word: RED, YELLOW, GREEN or INSUFFICIENT.
+    """
+
+def _findings_block(instructions, findings):
+    block = f"{instructions}\n\nVisual Findings: {findings}"
+    # Similar labelled cases depend only on the findings, so they stay inside the cached prefix
+    reference_cases = format_similar_cases(findings)
+    if reference_cases:
+        block += f"\n\n{reference_cases}"
+    return block
+
+def _prefixes(instructions, findings):
+    # Static instructions, then the same plus this session's findings
+    return [instructions, _findings_block(instructions, findings)]
+
+def _referral_prompt(findings, history, triage_level=None):
+    prompt = f"{_findings_block(REFERRAL_INSTRUCTIONS, findings)}\n\nPatient History: {history}"
+    if triage_level in ("RED", "YELLOW", "GREEN"):
+        prompt += f"\n\nThe triage level has already been assessed as {triage_level}."
+    return prompt
+
+def _triage_prompt(findings, history):
+    return f"{_findings_block(TRIAGE_INSTRUCTIONS, findings)}\n\nPatient History: {history}"
+
+_TRIAGE_LINE_RE = re.compile(r"TRIAGE(?:\s+LEVEL)?\W*(RED|YELLOW|GREEN|INSUFFICIENT)\b")
+
+def parse_triage_level(text):
+    """Maps free text to one of TRIAGE_LEVELS; an explicit "TRIAGE LEVEL: X" wins over other mentions."""
+    upper = text.upper()
+    stated = _TRIAGE_LINE_RE.search(upper)
+    if stated:
+        return stated.group(1)
+    if "INSUFFICIENT" in upper:
+        return "INSUFFICIENT"
+    match = re.search(r"\b(RED|YELLOW|GREEN)\b", upper)
+    if match:
+        return match.group(1)
+    # Unparseable answer: err on the side of an urgent referral
+    return "YELLOW"
+
+def _score_levels(pipe, messages, prefixes):
+    """
+    Scores each level by the next-token logit after the prompt: one forward
+    pass, no decoding, shared with concurrent sessions through the scoring
+    batcher. Returns None if the pipeline cannot be scored this way.
+    """
+    tokenizer = getattr(pipe, "tokenizer", None)
+    model = getattr(pipe, "model", None)
+    if tokenizer is None or model is None or not hasattr(tokenizer, "apply_chat_template"):
+        return None
+
+    key = id(tokenizer)
+    if key not in _level_token_ids:
+        _level_token_ids[key] = {
+            level: tokenizer.encode(level, add_special_tokens=False)[0] for level in TRIAGE_LEVELS
+        }
+    token_ids = _level_token_ids[key]
+    if len(set(token_ids.values())) != len(TRIAGE_LEVELS):
+        # Levels share a first token: fall back to constrained generation
+        return None
+
+    prompt, prefix_texts = render_prompt(tokenizer, messages, prefixes)
+    if prefix_cache_enabled():
+        try:
+            logits = prefix_cache.next_token_logits(model, tokenizer, prompt, prefix_texts)
+            return {level: logits[token_id].item() for level, token_id in token_ids.items()}
+        except Exception as e:
+            print(f"WARNING: Prefix KV cache scoring failed ({e}). Scoring the full prompt.")
+    scores = get_scorer().submit(prompt, token_ids=tuple(token_ids.values())).result()
+    return dict(zip(token_ids, scores))
+
+def get_scorer():
+    global scorer
+    with _scorer_lock:
+        if scorer is None:
+            scorer = MicroBatcher(
+                _score_batch,
+                max_batch_size=BATCH_MAX_SIZE,
+                max_wait_ms=BATCH_MAX_WAIT_MS,
+                name="medgemma-scorer"
+            )
+    return scorer
+
+def _score_batch(prompts, token_ids):
+    """
+    Next-token logits of token_ids after each prompt, in one forward pass.
+    Prompts are left-padded so every row ends at the last position; position
+    ids follow the attention mask so padding does not shift them.
+    """
+    import torch
+
+    with residency.use("medgemma"):
+        pipe = get_pipe()
+        tokenizer, model = pipe.tokenizer, pipe.model
+        rows = [tokenizer(prompt, add_special_tokens=False).input_ids for prompt in prompts]
+        width = max(len(row) for row in rows)
+        pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        input_ids = torch.full((len(rows), width), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), width), dtype=torch.long)
+        for i, row in enumerate(rows):
+            input_ids[i, width - len(row):] = torch.tensor(row, dtype=torch.long)
+            attention_mask[i, width - len(row):] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        inputs = {"input_ids": input_ids.to(model.device), "attention_mask": attention_mask.to(model.device),
+                  "position_ids": position_ids.to(model.device)}
+        with torch.no_grad():
+            try:
+                # Only the last position's logits: the full vocab for every prompt token is large
+                logits = model(**inputs, logits_to_keep=1).logits[:, -1]
+            except TypeError:
+                logits = model(**inputs).logits[:, -1]
+    selected = logits[:, list(token_ids)].float().cpu()
+    return selected.tolist()
+
+def get_scorer_stats():
+    """Queue depth and batch-size histogram of the triage scoring batcher."""
+    if scorer is None:
+        return {}
+    return scorer.stats()
+
+def classify_triage(findings, history, allow_insufficient=True):
+    """
+    Cheap sufficiency/triage decision used inside the interview loop.
+    Returns one of TRIAGE_LEVELS without writing the referral letter.
+    With allow_insufficient=False (forced decision once a session budget is
+    spent) the answer is restricted to RED, YELLOW or GREEN.
+    """
+    level, scores = classify_triage_with_scores(findings, history)
+    return forced_triage(level, scores) if not allow_insufficient else level
+
+def classify_triage_with_scores(findings, history):
+    """
+    classify_triage() that also returns the per-level logits it decided on:
+    (level, scores), with scores None when the level came from generation.
+    Keep them to make a later forced decision without another forward pass.
+    """
+    pipe = get_pipe()
+
+    if type(pipe).__name__ == "MockPipeline":
+        return parse_triage_level(_mock_referral(history)), None
+
+    prefixes = _prefixes(TRIAGE_INSTRUCTIONS, findings)
+    messages, gen_kwargs = build_request(_triage_prompt(findings, history), max_new_tokens=4)
+    if gen_kwargs.get("return_full_text") is False:
+        with residency.use("medgemma"):
+            scores = _score_levels(pipe, messages, prefixes)
+        if scores is not None:
+            return max(scores, key=scores.get), scores
+
+    # Short constrained generation
+    return parse_triage_level(run_pipeline(messages, prefixes=prefixes, **gen_kwargs)), None
+
+def forced_triage(level, scores=None):
+    """
+    RED, YELLOW or GREEN from an earlier classify_triage_with_scores() result:
+    the best-scoring level other than INSUFFICIENT. Without scores the same
+    prompt would be answered the same way, so only the restriction applies.
+    """
+    if scores:
+        scores = {lvl: score for lvl, score in scores.items() if lvl != "INSUFFICIENT"}
+        return max(scores, key=scores.get)
+    return _restrict(level, allow_insufficient=False)
+
+def _restrict(level, allow_insufficient):
+    # A forced decision errs on the side of an urgent referral, like parse_triage_level
+    if level == "INSUFFICIENT" and not allow_insufficient:
+        return "YELLOW"
+    return level
+
+def _mock_referral(history):
+    # Return a conditional mock result based on history length to simulate loop
+    if history and len(history.split('\n')) > 1:
+         return "REFERRAL DIAGNOSIS: Proliferative Diabetic Retinopathy. TRIAGE: Red (Emergency)."
+    else:
+         return "INSUFFICIENT_INFO. Please ask about blood sugar levels."
+
+def generate_referral(findings, history, triage_level=None):
     # Load shared pipe
-    pipe = load_medgemma_model()
+    pipe = get_pipe()
     
     # Check if Mock
     if type(pipe).__name__ == "MockPipeline":
-        # Return a conditional mock result based on history length to simulate loop
-        if history and len(history.split('\n')) > 1:
-             return "REFERRAL DIAGNOSIS: Proliferative Diabetic Retinopathy. TRIAGE: Red (Emergency)."
-        else:
-             return "INSUFFICIENT_INFO. Please ask about blood sugar levels."
-
-    # Check pipeline type to format input correctly
-    if hasattr(pipe, 'task') and pipe.task == "image-text-to-text":
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": base_prompt}
-                ]
-            }
-        ]
-        # Generate the response
-        output = pipe(messages, max_new_tokens=512)
-        return output[0]['generated_text']
-    else:
-        # Text-generation fallback structure (chat template)
-        messages = [
-            {"role": "user", "content": base_prompt}
-        ]
-        output = pipe(messages, max_new_tokens=512, return_full_text=False)
-        return output[0]['generated_text']
+        return _mock_referral(history)
+
+    messages, gen_kwargs = build_request(_referral_prompt(findings, history, triage_level))
+    return run_pipeline(messages, prefixes=_prefixes(REFERRAL_INSTRUCTIONS, findings), **gen_kwargs)
+
+def stream_referral(findings, history, triage_level=None):
+    """Streaming variant of generate_referral; yields the letter as it is written."""
+    pipe = get_pipe()
+
+    if type(pipe).__name__ == "MockPipeline":
+        yield _mock_referral(history)
+        return
+
+    messages, gen_kwargs = build_request(_referral_prompt(findings, history, triage_level))
+    yield from stream_pipeline(messages, **gen_kwargs)
 
 if __name__ == "__main__":
     findings = "Optic disc blurring observed."
     history = "Patient reports sudden vision loss in left eye starting 2 hours ago."
     print("--- Test Agent C ---")
+    print(f"Triage: {classify_triage(findings, history)}")
     print(generate_referral(findings, history))
@@ -1,24 +1,59 @@
-import torch
 from dotenv import load_dotenv
 load_dotenv()
-from transformers import pipeline, BitsAndBytesConfig
 import os
 import gc
+import sys
+import queue
+import threading
+from batcher import MicroBatcher
+from model_residency import residency
+from prefix_cache import prefix_cache, PREFIX_CACHE_ENABLED
+from exemplar_index import format_similar_cases
+from quantized_weights import find_artifact, load_quantized
+import speculative_decoding
+from speculative_decoding import SPECULATIVE_MIN_NEW_TOKENS
+import telemetry
 
 # Phase 3: Agent B - The Investigator
 # Model: MedGemma 1.5 4B-IT (google/medgemma-1.5-4b-it)
 
 MODEL_ID = "google/gemma-2-2b-it"
 
-# Configure 4-bit quantization
-bnb_config = BitsAndBytesConfig(
-    load_in_4bit=True,
-    bnb_4bit_quant_type="nf4",
-    bnb_4bit_compute_dtype=torch.bfloat16
-)
+# torch/transformers are imported inside the functions that need them so that
+# importing this module stays cheap (see agent_registry.py)
+
+def _bnb_config():
+    import torch
+    from transformers import BitsAndBytesConfig
+    # Configure 4-bit quantization
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.bfloat16
+    )
+
+# Micro-batching window for the shared pipeline (see batcher.py)
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 8))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 20))
+
+# Footprint assumed before the first load has been measured
+ESTIMATED_MODEL_MB = float(os.environ.get("MEDGEMMA_ESTIMATED_MB", 2000))
 
 # pipeline cache
 pipe = None
+# Draft model for assisted decoding (speculative_decoding.py); None = plain decoding
+draft = None
+
+# request batcher shared by Agent B and Agent C
+batcher = None
+_batcher_lock = threading.Lock()
+
+# Set if the model does not support prefix caching; we stop trying after that
+_prefix_cache_disabled = not PREFIX_CACHE_ENABLED
+# Set if assisted generation fails for this model/transformers combination
+_speculative_disabled = False
+# Set if assisted generation works, but not on top of a cached prompt prefix
+_speculative_prefix_disabled = False
 
 class MockPipeline:
     def __init__(self, task="text-generation"):
@@ -26,27 +61,47 @@ class MockPipeline:
     
     def __call__(self, messages, **kwargs):
         # Return dummy output structure
-        return [{'generated_text': "Is the vision loss sudden or gradual?"}]
+        output = [{'generated_text': "Is the vision loss sudden or gradual?"}]
+        # A list of chats is a batch: one output list per chat
+        if messages and isinstance(messages[0], list):
+            return [list(output) for _ in messages]
+        return output
 
 def load_medgemma_model():
-    global pipe
+    global pipe, draft
     if pipe is not None:
         return pipe
 
     print(f"Initializing Agent B (Investigator) with model: {MODEL_ID}")
     try:
+        import torch
+        from transformers import pipeline
         # Gemma 2 is a text model, so we must use "text-generation"
         # Using model_kwargs for dtype as requested
-        new_pipe = pipeline(
-            "text-generation", 
-            model=MODEL_ID, 
-            model_kwargs={
-                "dtype": torch.bfloat16,
-                "low_cpu_mem_usage": True,
-                "quantization_config": bnb_config
-            },
-            device_map="auto"
-        )
+        artifact = find_artifact(MODEL_ID)
+        if artifact and not torch.cuda.is_available():
+            # Pre-quantized artifact from export_models.py, memory-mapped
+            from transformers import AutoModelForCausalLM, AutoTokenizer
+            print(f"CUDA not found. Loading quantized artifact from {artifact}.")
+            new_pipe = pipeline(
+                "text-generation",
+                model=load_quantized(AutoModelForCausalLM, artifact),
+                tokenizer=AutoTokenizer.from_pretrained(artifact)
+            )
+        else:
+            new_pipe = pipeline(
+                "text-generation", 
+                model=MODEL_ID, 
+                model_kwargs={
+                    "dtype": torch.bfloat16,
+                    "low_cpu_mem_usage": True,
+                    "quantization_config": _bnb_config()
+                },
+                device_map="auto"
+            )
+        # Batched decoder-only generation needs left padding
+        new_pipe.tokenizer.padding_side = "left"
+        draft = speculative_decoding.load_draft(new_pipe.model, new_pipe.tokenizer)
         print("Agent B initialized successfully.")
         pipe = new_pipe
         return pipe
@@ -57,50 +112,324 @@ def load_medgemma_model():
         return pipe
 
 def unload_model():
-    global pipe
+    global pipe, draft
+    if draft is not None:
+        draft.close()
+        draft = None
     if pipe is not None:
         del pipe
         gc.collect()
-        torch.cuda.empty_cache()
+        if "torch" in sys.modules:
+            sys.modules["torch"].cuda.empty_cache()
         pipe = None
         print("Agent B/C Model unloaded.")
 
-def generate_interview_question(visual_findings, history=None):
-    system_prompt = """
-    You are an ophthalmic nurse assistant. 
-    Based on the visual findings from a retinal scan and any patient history provided, 
-    determine ONE crucial follow-up question to ask the patient to assess urgency 
-    (e.g., sudden vision loss, flashes, or floaters).
-    Do not ask questions that have already been answered in the history.
+def _model_size_mb():
+    model = getattr(pipe, "model", None)
+    if model is None or not hasattr(model, "get_memory_footprint"):
+        return 0
+    size = model.get_memory_footprint() / (1024 * 1024)
+    return size + (draft.footprint_mb() if draft is not None else 0)
+
+# Agent B and Agent C share this pipeline; keep it warm across sessions
+residency.register(
+    "medgemma",
+    load_fn=load_medgemma_model,
+    unload_fn=unload_model,
+    is_loaded_fn=lambda: pipe is not None,
+    size_fn=_model_size_mb,
+    estimated_mb=ESTIMATED_MODEL_MB
+)
+
+def get_pipe():
+    """Returns the shared pipeline, loading it through the residency manager."""
+    with residency.use("medgemma"):
+        return pipe
+
+@telemetry.traced("medgemma_batch", kind="pipeline")
+def _run_batch(messages_batch, **gen_kwargs):
+    """Runs a list of chats through the pipeline as a single batched call."""
+    with residency.use("medgemma"):
+        outputs = pipe(messages_batch, batch_size=len(messages_batch), **gen_kwargs)
+    telemetry.annotate(batch_size=len(messages_batch))
+    return [output[0]['generated_text'] for output in outputs]
+
+def get_batcher():
+    global batcher
+    with _batcher_lock:
+        if batcher is None:
+            batcher = MicroBatcher(
+                _run_batch,
+                max_batch_size=BATCH_MAX_SIZE,
+                max_wait_ms=BATCH_MAX_WAIT_MS,
+                name="medgemma-batcher"
+            )
+    return batcher
+
+@telemetry.traced("medgemma", kind="pipeline")
+def run_pipeline(messages, prefixes=None, **gen_kwargs):
+    """
+    Submits one chat to the shared micro-batcher and blocks for its text.
+    Concurrent sessions arriving within the batching window share a forward pass.
+    With the prefix KV cache switched on (PREFIX_CACHE_ENABLED=1, off by
+    default) and prefixes (leading parts of the user message) given, the call
+    is served from the cache instead: only the new part of the prompt is
+    prefilled, but the call runs alone, serialised with other cached calls,
+    rather than in a batch. Long outputs with a draft model loaded go through
+    assisted generation, which is single-sequence as well.
     """
+    text = None
+    prefixes = prefixes if prefixes and not _prefix_cache_disabled else None
+    if _use_speculative(gen_kwargs):
+        # Assisted generation still reuses the cached prefix when it can
+        text = _run_speculative(messages, prefixes=prefixes, **gen_kwargs)
+    if text is None and prefixes:
+        text = _run_with_prefix_cache(messages, prefixes, **gen_kwargs)
+    if text is None:
+        text = get_batcher().submit(messages, **gen_kwargs).result()
+    if telemetry.TELEMETRY_ENABLED:
+        _annotate_tokens(messages, text)
+    return text
 
-    context_text = f"Visual Findings: {visual_findings}"
-    if history:
-        context_text += f"\n\nPatient History/Previous Answers: {history}"
+def _annotate_tokens(messages, text):
+    """Prompt/completion token counts for the active span (words when there is no tokenizer)."""
+    tokenizer = getattr(pipe, "tokenizer", None)
+    if tokenizer is None:
+        telemetry.annotate(prompt_tokens=len(str(messages[-1]["content"]).split()), completion_tokens=len(text.split()))
+        return
+    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    telemetry.annotate(
+        prompt_tokens=len(tokenizer.encode(prompt, add_special_tokens=False)),
+        completion_tokens=len(tokenizer.encode(text, add_special_tokens=False))
+    )
+
+def render_prompt(tokenizer, messages, prefixes):
+    """
+    Applies the chat template and maps message-level prefixes onto the
+    rendered prompt. Returns (prompt_text, prefix_texts).
+    """
+    prompt_text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    content = messages[-1]["content"]
+    offset = prompt_text.find(content)
+    if offset < 0:
+        return prompt_text, []
+    return prompt_text, [prompt_text[:offset + len(p)] for p in prefixes if content.startswith(p)]
+
+def _run_with_prefix_cache(messages, prefixes, max_new_tokens=512, return_full_text=True, **assistant_kwargs):
+    global _prefix_cache_disabled
+    with residency.use("medgemma"):
+        local_pipe = pipe
+        if isinstance(local_pipe, MockPipeline) or local_pipe.task != "text-generation" or return_full_text:
+            return None
+        tokenizer = local_pipe.tokenizer
+        prompt_text, prefix_texts = render_prompt(tokenizer, messages, prefixes)
+        try:
+            return prefix_cache.generate(
+                local_pipe.model, tokenizer, prompt_text, prefix_texts, max_new_tokens=max_new_tokens,
+                **assistant_kwargs
+            )
+        except Exception as e:
+            if assistant_kwargs:
+                # The caller decides whether the cache or assisted generation is at fault
+                raise
+            print(f"WARNING: Prefix KV cache unavailable for this model ({e}). Using the plain pipeline.")
+            _prefix_cache_disabled = True
+            prefix_cache.clear()
+            return None
+
+def _use_speculative(gen_kwargs):
+    # Worth it for long outputs only; the triage label is a few tokens
+    return (draft is not None and not _speculative_disabled
+            and gen_kwargs.get("max_new_tokens", 0) >= SPECULATIVE_MIN_NEW_TOKENS)
+
+def _run_speculative(messages, prefixes=None, streamer=None, **gen_kwargs):
+    """
+    One chat through assisted generation with the draft model, on top of the
+    prefix KV cache when prefixes are given. Bypasses the micro-batcher
+    (assisted generation is single-sequence). Returns None if the model does
+    not support it, after which plain decoding is used. A failure after the
+    streamer has emitted text is raised instead: retrying would repeat it.
+    """
+    global _speculative_disabled, _speculative_prefix_disabled
+    with residency.use("medgemma"):
+        local_pipe, decoder = pipe, draft
+        if decoder is None or isinstance(local_pipe, MockPipeline):
+            return None
+        if prefixes and streamer is None and not _speculative_prefix_disabled:
+            try:
+                text = decoder.run(
+                    lambda assistant_kwargs: _run_with_prefix_cache(messages, prefixes, **gen_kwargs, **assistant_kwargs)
+                )
+            except Exception as e:
+                print(f"WARNING: Assisted generation over the prefix KV cache failed ({e}). "
+                      "Running it without the cache.")
+                _speculative_prefix_disabled = True
+            else:
+                if text is not None:
+                    return text
+        extra = {"streamer": streamer} if streamer is not None else {}
+        try:
+            return decoder.run(
+                lambda assistant_kwargs: local_pipe(messages, **gen_kwargs, **extra, **assistant_kwargs)[0]['generated_text']
+            )
+        except Exception as e:
+            print(f"WARNING: Speculative decoding failed for this model ({e}). Using plain decoding.")
+            _speculative_disabled = True
+            if getattr(streamer, "emitted", False):
+                raise
+            return None
+
+def get_speculative_stats():
+    """Draft acceptance rate and tokens/sec of assisted generation ({} when disabled)."""
+    if draft is None:
+        return {}
+    return dict(draft.stats(), disabled=_speculative_disabled)
 
+def prefix_cache_enabled():
+    return not _prefix_cache_disabled
+
+def count_tokens(text):
+    """Tokens in text for the loaded pipeline's tokenizer (words for the mock)."""
+    tokenizer = getattr(pipe, "tokenizer", None)
+    if tokenizer is None:
+        return len(text.split())
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+def get_prefix_cache_stats():
+    """Hits, misses and prefill tokens saved by the prefix KV cache."""
+    return prefix_cache.stats()
+
+def get_batcher_stats():
+    """Queue depth and batch-size histogram for tuning the batching window."""
+    if batcher is None:
+        return {}
+    return batcher.stats()
+
+def stream_pipeline(messages, **gen_kwargs):
+    """
+    Yields the accumulated text while the pipeline is still generating.
+    Streaming requests bypass the micro-batcher: time-to-first-token matters
+    more than throughput for interactive sessions. Closing the generator early
+    (e.g. the client disconnected) stops the generation at the next token.
+    """
+    with residency.use("medgemma"):
+        local_pipe = pipe
+
+        if isinstance(local_pipe, MockPipeline):
+            text = local_pipe(messages, **gen_kwargs)[0]['generated_text']
+            partial = ""
+            for word in text.split(" "):
+                partial = f"{partial} {word}" if partial else word
+                yield partial
+            return
+
+        from transformers import StoppingCriteria, StoppingCriteriaList, TextStreamer
+        tokenizer = getattr(local_pipe, "tokenizer", None) or local_pipe.processor.tokenizer
+        chunks = queue.Queue()
+        errors = []
+        cancelled = threading.Event()
+
+        class ChunkStreamer(TextStreamer):
+            """Forwards decoded text to the consumer below and remembers whether any went out."""
+            emitted = False
+
+            def on_finalized_text(self, text, stream_end=False):
+                if text:
+                    self.emitted = True
+                    chunks.put(text)
+
+        class StopWhenCancelled(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return cancelled.is_set()
+
+        gen_kwargs = dict(gen_kwargs, stopping_criteria=StoppingCriteriaList([StopWhenCancelled()]))
+
+        def new_streamer():
+            return ChunkStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+        def generate():
+            try:
+                # A failed assisted attempt that emitted nothing falls back on a fresh streamer
+                if _use_speculative(gen_kwargs) and _run_speculative(messages, streamer=new_streamer(), **gen_kwargs) is not None:
+                    return
+                local_pipe(messages, streamer=new_streamer(), **gen_kwargs)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # Unblock the consumer loop below
+                chunks.put(None)
+
+        thread = threading.Thread(target=generate, name="medgemma-stream", daemon=True)
+        thread.start()
+        text = ""
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                text += chunk
+                yield text
+        except GeneratorExit:
+            # Nobody is reading any more: let the generation thread finish early
+            cancelled.set()
+            raise
+        thread.join()
+        if errors:
+            raise errors[0]
+
+def build_request(prompt_text, max_new_tokens=512):
+    """Formats a prompt for the loaded pipeline. Returns (messages, generation kwargs)."""
     # Load model if not loaded
-    local_pipe = load_medgemma_model()
+    local_pipe = get_pipe()
 
     # If using the 'image-text-to-text' pipeline with VLM structure
-    if local_pipe.task == "image-text-to-text":
+    if getattr(local_pipe, "task", None) == "image-text-to-text":
         messages = [
             {
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": f"{system_prompt}\n\n{context_text}"}
+                    {"type": "text", "text": prompt_text}
                 ]
             }
         ]
-        # Generate the response
-        output = local_pipe(messages, max_new_tokens=512)
-        return output[0]['generated_text']
+        return messages, {"max_new_tokens": max_new_tokens}
     else:
         # Text-generation fallback structure (chat template)
         messages = [
-            {"role": "user", "content": f"{system_prompt}\n\n{context_text}"}
+            {"role": "user", "content": prompt_text}
         ]
-        output = local_pipe(messages, max_new_tokens=512, return_full_text=False)
-        return output[0]['generated_text']
+        return messages, {"max_new_tokens": max_new_tokens, "return_full_text": False}
+
+QUESTION_SYSTEM_PROMPT = """
+    You are an ophthalmic nurse assistant. 
+    Based on the visual findings from a retinal scan and any patient history provided, 
+    determine ONE crucial follow-up question to ask the patient to assess urgency 
+    (e.g., sudden vision loss, flashes, or floaters).
+    Do not ask questions that have already been answered in the history.
+    """
+
+def _question_prompt(visual_findings, history=None):
+    context_text = f"Visual Findings: {visual_findings}"
+    # Ground the question in similar labelled cases (precomputed index, no model call)
+    reference_cases = format_similar_cases(visual_findings)
+    if reference_cases:
+        context_text += f"\n\n{reference_cases}"
+    if history:
+        context_text += f"\n\nPatient History/Previous Answers: {history}"
+    return f"{QUESTION_SYSTEM_PROMPT}\n\n{context_text}"
+
+def _question_prefixes(visual_findings):
+    # Static instructions, then the same plus this session's findings
+    return [QUESTION_SYSTEM_PROMPT, _question_prompt(visual_findings)]
+
+def generate_interview_question(visual_findings, history=None):
+    messages, gen_kwargs = build_request(_question_prompt(visual_findings, history))
+    return run_pipeline(messages, prefixes=_question_prefixes(visual_findings), **gen_kwargs)
+
+def stream_interview_question(visual_findings, history=None):
+    """Streaming variant of generate_interview_question; yields partial text."""
+    messages, gen_kwargs = build_request(_question_prompt(visual_findings, history))
+    yield from stream_pipeline(messages, **gen_kwargs)
 
 if __name__ == "__main__":
     # Test stub
@@ -1,126 +1,351 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
-import torch
-import numpy as np
 from PIL import Image
-from transformers import PaliGemmaForConditionalGeneration, PaliGemmaProcessor, BitsAndBytesConfig
-from dotenv import load_dotenv
 import json
 import gc
+import sys
+import time
+import threading
+from model_residency import residency
+from findings_cache import get_cache, image_digest, make_key
+from quantized_weights import find_artifact
+import cpu_backend
+import fundus_preprocess
+from fundus_preprocess import FAST_PREPROCESS, PREPROCESS_VERSION
+import telemetry
 
 load_dotenv()
 
 # Configuration
 # Use the Google version from HF Hub
 MODEL_ID = "google/paligemma-3b-mix-224"
-# Configure 4-bit quantization
-bnb_config = BitsAndBytesConfig(
-    load_in_4bit=True,
-    bnb_4bit_quant_type="nf4",
-    bnb_4bit_compute_dtype=torch.bfloat16
-)
 
-print(f"Loading {MODEL_ID} with Transformers...")
+# torch/transformers are imported inside the functions that need them so that
+# importing this module stays cheap (see agent_registry.py)
+
+def _bnb_config():
+    import torch
+    from transformers import BitsAndBytesConfig
+    # Configure 4-bit quantization
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.bfloat16
+    )
 
 # Global model/processor cache
 model = None
 processor = None
 
-MOCK_MODE = True
+# Inference backend: mock | auto | cuda | cpu-int8 | cpu-bf16 | onnx
+# "auto" uses CUDA (4-bit) when available and cpu-int8 otherwise (see cpu_backend.py)
+OBSERVER_BACKEND = os.environ.get("OBSERVER_BACKEND", "mock").lower()
+MOCK_MODE = OBSERVER_BACKEND == "mock"
+# Backend actually serving the model once loaded
+active_backend = "mock" if MOCK_MODE else None
+
+# Task prompt and generation settings (also part of the findings cache key)
+PROMPT = "caption en"
+GENERATION_PARAMS = {"max_new_tokens": 128}
+
+MOCK_FINDINGS = "Severe diabetic retinopathy with microaneurysms and hard exudates detected. Optic disc cup-to-disc ratio is 0.6. Macula shows signs of edema."
+
+# Footprint assumed before the first load has been measured
+ESTIMATED_MODEL_MB = float(os.environ.get("OBSERVER_ESTIMATED_MB", 3000))
+
+_processor_lock = threading.Lock()
+# Fast fundus preprocessing state (prompt ids, buffer pool), built with the processor
+_fast = None
+
+def load_processor():
+    """The processor is small and needed by the preprocessing stage, so it is loaded on its own."""
+    global processor
+    with _processor_lock:
+        if processor is None:
+            from transformers import PaliGemmaProcessor
+            print("Initializing Processor...")
+            # Exported artifacts carry their own processor files (no Hub access needed)
+            processor = PaliGemmaProcessor.from_pretrained(find_artifact(MODEL_ID) or MODEL_ID)
+    return processor
+
+def _resolve_backend():
+    if OBSERVER_BACKEND != "auto":
+        return OBSERVER_BACKEND
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu-int8"
 
 def load_model():
-    global model, processor, MOCK_MODE
+    global model, MOCK_MODE, active_backend
     if model is None and not MOCK_MODE:
+        backend = None
         try:
-            print("Initializing Processor...")
-            processor = PaliGemmaProcessor.from_pretrained(MODEL_ID)
-            
-            print("Initializing Model (4-bit quantization)...")
-            # Note: BitsAndBytes requires CUDA. If no CUDA, this will fail.
-            if torch.cuda.is_available():
+            import torch
+            from transformers import PaliGemmaForConditionalGeneration
+            backend = _resolve_backend()
+            print(f"Loading {MODEL_ID} with the {backend} backend...")
+            load_processor()
+
+            if backend == "cuda":
+                print("Initializing Model (4-bit quantization)...")
+                # Note: BitsAndBytes requires CUDA. If no CUDA, this will fail.
                 model = PaliGemmaForConditionalGeneration.from_pretrained(
                     MODEL_ID,
-                    quantization_config=bnb_config,
+                    quantization_config=_bnb_config(),
                     device_map="auto",
                     low_cpu_mem_usage=True
                 )
             else:
-                print("CUDA not found. Falling back to CPU/Float32 (Warning: High RAM usage).")
-                model = PaliGemmaForConditionalGeneration.from_pretrained(
-                    MODEL_ID,
-                    torch_dtype=torch.float32,
-                    device_map="cpu",
-                    low_cpu_mem_usage=True
-                )
-            print("Agent A Model loaded successfully.")
+                model = cpu_backend.load(backend, PaliGemmaForConditionalGeneration, MODEL_ID)
+            active_backend = backend
+            print(f"Agent A Model loaded successfully ({backend}).")
         except Exception as e:
-            print(f"Error loading model: {e}")
-            print("WARNING: Model loading failed (likely OOM). Switching to MOCK_MODE.")
+            print(f"Error loading model with the {backend} backend: {e}")
+            print("WARNING: Model loading failed. Switching to MOCK_MODE: findings will be the canned mock text.")
             MOCK_MODE = True
+            active_backend = "mock"
 
 def unload_model():
-    global model, processor, MOCK_MODE
+    global model, MOCK_MODE
     if model is not None:
         del model
         model = None
-    if processor is not None:
-        del processor
-        processor = None
+    # The processor stays loaded: it is small and preprocessing keeps using it
     gc.collect()
-    torch.cuda.empty_cache()
+    if "torch" in sys.modules:
+        sys.modules["torch"].cuda.empty_cache()
     # Don't reset MOCK_MODE here, so we don't retry loading indefinitely
     print("Agent A (Observer) model unloaded.")
 
+def _model_size_mb():
+    if model is None or not hasattr(model, "get_memory_footprint"):
+        return 0
+    return model.get_memory_footprint() / (1024 * 1024)
 
+# Keep the model warm across sessions; the residency manager decides when to evict
+residency.register(
+    "observer",
+    load_fn=load_model,
+    unload_fn=unload_model,
+    is_loaded_fn=lambda: model is not None or MOCK_MODE,
+    size_fn=_model_size_mb,
+    estimated_mb=ESTIMATED_MODEL_MB
+)
+
+
+def _open_image(image_path):
+    if FAST_PREPROCESS:
+        # Reduced-scale JPEG decode (see fundus_preprocess.py)
+        return fundus_preprocess.decode(image_path)
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image not found at {image_path}")
+    return Image.open(image_path).convert("RGB")
+
+def _cache_key(image):
+    params = {**GENERATION_PARAMS, "preprocess": PREPROCESS_VERSION} if FAST_PREPROCESS else GENERATION_PARAMS
+    return make_key(image_digest(image), MODEL_ID, PROMPT, params)
+
+def _fast_preprocessor():
+    global _fast
+    if _fast is None:
+        _fast = fundus_preprocess.FundusPreprocessor(load_processor())
+    return _fast
 
 def get_visual_findings(image_path):
     """
     Generates a descriptive text of visual findings from a retinal scan.
+    Repeat scans of the same pixels are served from the findings cache.
     """
-    if model is None:
-        load_model()
-        
+    return generate_findings(preprocess_image(image_path))
+
+def preprocess_image(image_path):
+    """
+    CPU stage: decode the image, look it up in the findings cache and run the
+    PaliGemmaProcessor. Does not need the model, so it can run on a worker pool
+    while another image is being generated.
+    """
+    prepared = {"image_path": image_path, "cache_key": None, "findings": None, "inputs": None, "buffer": None}
     if MOCK_MODE:
-        return "Severe diabetic retinopathy with microaneurysms and hard exudates detected. Optic disc cup-to-disc ratio is 0.6. Macula shows signs of edema."
+        return prepared
 
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"Image not found at {image_path}")
+    image = _open_image(image_path)
+    cache = get_cache()
+    if cache is not None:
+        prepared["cache_key"] = _cache_key(image)
+        prepared["findings"] = cache.get(prepared["cache_key"])
+        if prepared["findings"] is not None:
+            print("[Agent A] Findings cache hit.")
+            return prepared
 
-    # Load Image
-    image = Image.open(image_path).convert("RGB")
-    
-    # Prompt
-    prompt = "caption en"
-    
-    # Preprocess
-    inputs = processor(text=prompt, images=image, return_tensors="pt")
-    
+    if FAST_PREPROCESS:
+        # Cropped, normalised pixels and cached prompt ids; the processor is not called
+        prepared["inputs"], prepared["buffer"] = _fast_preprocessor().inputs(image, PROMPT)
+    else:
+        prepared["inputs"] = load_processor()(text=PROMPT, images=image, return_tensors="pt")
+    return prepared
+
+@telemetry.traced("observer_generate", kind="pipeline")
+def generate_findings(prepared):
+    """Model stage: runs generate() on the output of preprocess_image()."""
+    if prepared["findings"] is not None:
+        return prepared["findings"]
+
+    with residency.use("observer"):
+        if MOCK_MODE:
+            return MOCK_FINDINGS
+        if prepared["inputs"] is None:
+            # Preprocessed while still in MOCK_MODE
+            prepared = preprocess_image(prepared["image_path"])
+            if prepared["findings"] is not None:
+                return prepared["findings"]
+        try:
+            result = _generate(prepared["inputs"])
+        finally:
+            if prepared["buffer"] is not None:
+                _fast_preprocessor().release(prepared["buffer"])
+                prepared["buffer"] = None
+
+    if prepared["cache_key"] is not None:
+        get_cache().put(prepared["cache_key"], result)
+    return result
+
+def _generate(inputs):
+    import torch
     # Move inputs to same device as model
     device = model.device
-    input_ids = inputs.input_ids.to(device)
-    pixel_values = inputs.pixel_values.to(device)
-    attention_mask = inputs.attention_mask.to(device)
+    input_ids = inputs["input_ids"].to(device)
+    pixel_values = inputs["pixel_values"].to(device)
+    attention_mask = inputs["attention_mask"].to(device)
 
     # Generate
+    start = time.perf_counter()
     with torch.no_grad():
         generated_ids = model.generate(
             input_ids=input_ids,
             pixel_values=pixel_values,
             attention_mask=attention_mask,
-            max_new_tokens=128
+            **GENERATION_PARAMS
         )
+    _report_tokens(generated_ids, input_ids, start)
     
     # Decode
     result = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
     
+    return _clean_caption(result, PROMPT)
+
+def _clean_caption(result, prompt):
     # Simple clean up if prompt is repeated in output
     if result.startswith(prompt):
         # Often PaliGemma outputs "\n" after prompt
         result = result[len(prompt):].strip()
-        
     return result
 
+def get_visual_findings_batch(image_paths, batch_size=8):
+    """
+    Batched version of get_visual_findings for screening camps.
+    Inputs are taken batch_size at a time: each image is decoded once, the
+    decoded copy gives both the findings-cache key and the model input, cached
+    images are answered directly and the rest of the batch is run through a
+    single generate() call. Findings are returned in input order.
+    """
+    image_paths = list(image_paths)
+    if not image_paths:
+        return []
+
+    start = time.perf_counter()
+    results = []
+    hits = 0
+    # Batch pixel buffer reused across batches (fast path only)
+    batch_buffer = None
+    cache = None if MOCK_MODE else get_cache()
+    for i in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[i:i + batch_size]
+        images = [None] * len(batch_paths) if MOCK_MODE else [_open_image(path) for path in batch_paths]
+        found = [None] * len(batch_paths)
+        keys = [None] * len(batch_paths)
+        pending = list(range(len(batch_paths)))
+        if cache is not None:
+            pending = []
+            for j, image in enumerate(images):
+                keys[j] = _cache_key(image)
+                found[j] = cache.get(keys[j])
+                if found[j] is None:
+                    pending.append(j)
+            hits += len(batch_paths) - len(pending)
+
+        if pending:
+            with residency.use("observer"):
+                generated, batch_buffer = _get_visual_findings_batch(
+                    [batch_paths[j] for j in pending], [images[j] for j in pending], batch_buffer
+                )
+            for j, text in zip(pending, generated):
+                found[j] = text
+                if keys[j] is not None and not MOCK_MODE:
+                    cache.put(keys[j], text)
+        results.extend(found)
+
+    if hits:
+        print(f"[Agent A] Findings cache: {hits}/{len(image_paths)} hits.")
+    _report_throughput(len(results), start)
+    return results
+
+def _get_visual_findings_batch(image_paths, images, batch_buffer=None):
+    """One generate() call over already decoded images. Returns (findings, pixel buffer)."""
+    import torch
+    if MOCK_MODE:
+        return [MOCK_FINDINGS for _ in image_paths], batch_buffer
+
+    device = model.device
+    # Decoder-only generation needs left padding so every row ends at the prompt
+    processor.tokenizer.padding_side = "left"
+
+    if FAST_PREPROCESS:
+        # Same prompt on every row: no padding, prompt ids from the cache
+        inputs, batch_buffer = _fast_preprocessor().batch_inputs(images, PROMPT, out=batch_buffer)
+    else:
+        inputs = processor(
+            text=[PROMPT] * len(images),
+            images=images,
+            padding="longest",
+            return_tensors="pt"
+        )
+    input_ids = inputs["input_ids"].to(device)
+    pixel_values = inputs["pixel_values"].to(device)
+    attention_mask = inputs["attention_mask"].to(device)
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        generated_ids = model.generate(
+            input_ids=input_ids,
+            pixel_values=pixel_values,
+            attention_mask=attention_mask,
+            **GENERATION_PARAMS
+        )
+    _report_tokens(generated_ids, input_ids, start)
+
+    # Only decode the newly generated tokens of each row
+    new_tokens = generated_ids[:, input_ids.shape[1]:]
+    decoded = processor.batch_decode(new_tokens, skip_special_tokens=True)
+    return [_clean_caption(text.strip(), PROMPT) for text in decoded], batch_buffer
+
+def _report_tokens(generated_ids, input_ids, start):
+    elapsed = time.perf_counter() - start
+    new_tokens = (generated_ids.shape[1] - input_ids.shape[1]) * generated_ids.shape[0]
+    rate = cpu_backend.record_throughput(active_backend, new_tokens, elapsed)
+    telemetry.annotate(prompt_tokens=input_ids.numel(), completion_tokens=new_tokens, backend=active_backend)
+    print(f"[Agent A] {active_backend}: {new_tokens} tokens in {elapsed:.2f}s ({rate:.1f} tokens/s)")
+
+def get_backend_stats():
+    """Active backend and cumulative generation throughput per backend."""
+    return {"backend": active_backend, "throughput": cpu_backend.throughput_stats()}
+
+def _report_throughput(num_images, start):
+    elapsed = time.perf_counter() - start
+    per_image = elapsed / num_images if num_images else 0.0
+    rate = num_images / elapsed if elapsed > 0 else float("inf")
+    print(f"[Agent A] Batch: {num_images} images in {elapsed:.2f}s "
+          f"({per_image:.3f}s/image, {rate:.2f} images/s)")
+
 if __name__ == "__main__":
     # Test stub
     json_path = "few_shot_examples.json"
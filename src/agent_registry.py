@@ -0,0 +1,139 @@
+import os
+import inspect
+import importlib
+import threading
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Lazy agent registry.
+# Entry points (orchestrator, Gradio, pipelines) go through this instead of
+# importing the agents eagerly. An agent module is imported on first attribute
+# access, model weights load on first use (via model_residency), and an
+# optional background thread can warm everything up while the server is
+# already accepting connections.
+
+AGENT_MODULES = {
+    "observer": "agent_observer",
+    "investigator": "agent_investigator",
+    "diagnostician": "agent_diagnostician",
+}
+
+# Residency names of the models each agent needs
+AGENT_MODELS = {
+    "observer": "observer",
+    "investigator": "medgemma",
+    "diagnostician": "medgemma",
+}
+
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "1") == "1"
+
+_modules = {}
+_timings = {"import_s": {}, "first_call_s": {}}
+_lock = threading.RLock()
+_warmup_thread = None
+_process_start = time.perf_counter()
+
+
+def get_agent(name):
+    """Imports (once) and returns the module backing an agent."""
+    with _lock:
+        module = _modules.get(name)
+        if module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(AGENT_MODULES[name])
+            _timings["import_s"][name] = time.perf_counter() - started
+            _modules[name] = module
+        return module
+
+
+class LazyAgent:
+    """Module stand-in: imports the agent on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(get_agent(self._name), attr)
+        if callable(value) and not attr.startswith("_") and self._name not in _timings["first_call_s"]:
+            return _time_first_call(self._name, value)
+        return value
+
+
+def _time_first_call(name, fn):
+    def record(started):
+        with _lock:
+            _timings["first_call_s"].setdefault(name, time.perf_counter() - started)
+
+    if inspect.isgeneratorfunction(fn):
+        # Streaming calls do their work while being iterated: time until exhausted
+        def stream_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                yield from fn(*args, **kwargs)
+            finally:
+                record(started)
+        return stream_wrapper
+
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record(started)
+    return wrapper
+
+
+def lazy(name):
+    return LazyAgent(name)
+
+
+def warm_up(load_weights=True):
+    """Imports every agent and, optionally, loads their model weights."""
+    for name in AGENT_MODULES:
+        get_agent(name)
+    if load_weights:
+        from model_residency import residency
+        for model_name in sorted(set(AGENT_MODELS.values())):
+            with residency.use(model_name):
+                pass
+    print(f"[Startup] Warm-up finished {time.perf_counter() - _process_start:.1f}s after start.")
+
+
+def start_warmup(load_weights=True):
+    """Runs warm_up() on a background thread so the server can bind immediately."""
+    global _warmup_thread
+    with _lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(
+                target=warm_up, kwargs={"load_weights": load_weights}, name="agent-warmup", daemon=True
+            )
+            _warmup_thread.start()
+    return _warmup_thread
+
+
+def startup_report():
+    """Per-agent breakdown of import, weight-load and first-call cost (seconds)."""
+    from model_residency import residency
+    load_seconds = residency.stats().get("load_seconds", {})
+    with _lock:
+        report = {}
+        for name in AGENT_MODULES:
+            report[name] = {
+                "import_s": _timings["import_s"].get(name),
+                "weight_load_s": load_seconds.get(AGENT_MODELS[name]),
+                # Includes weight loading if the agent was not warmed up first
+                "first_call_s": _timings["first_call_s"].get(name),
+            }
+        report["uptime_s"] = time.perf_counter() - _process_start
+    return report
+
+
+def print_startup_report():
+    report = startup_report()
+    print("[Startup] agent          import   weights  first call")
+    for name in AGENT_MODULES:
+        row = report[name]
+        cells = [f"{row[k]:8.2f}s" if row[k] is not None else "       -" for k in ("import_s", "weight_load_s", "first_call_s")]
+        print(f"[Startup] {name:<13} {' '.join(cells)}")
@@ -0,0 +1,147 @@
+import os
+import sys
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+load_dotenv()
+
+# Add current directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import orchestrator
+
+# Asyncio runner for the triage graph.
+# Sessions spend most of their time waiting on patients, so each session is a
+# coroutine rather than a thread. Blocking model calls are offloaded to one
+# bounded executor shared by every session; patient answers arrive through an
+# AnswerChannel instead of input().
+
+INFERENCE_WORKERS = int(os.environ.get("ASYNC_INFERENCE_WORKERS", 4))
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+    return _executor
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Runs a blocking (model) call on the shared inference executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+class AnswerChannel:
+    """Awaitable question/answer exchange between one session and its patient."""
+
+    def __init__(self):
+        self.questions = asyncio.Queue()
+        self.answers = asyncio.Queue()
+
+    async def ask(self, question):
+        """Called by the graph: publishes a question and waits for the answer."""
+        await self.questions.put(question)
+        return await self.answers.get()
+
+    async def next_question(self):
+        """Called by the client: waits for the next question (None when the session ends)."""
+        return await self.questions.get()
+
+    async def answer(self, text):
+        await self.answers.put(text)
+
+    async def close(self):
+        await self.questions.put(None)
+
+
+# --- Async Node Definitions ---
+# The agent nodes reuse the synchronous implementations on the executor.
+
+async def quality_gate_node(state):
+    return await run_blocking(orchestrator.quality_gate_node, state)
+
+async def observer_node(state):
+    return await run_blocking(orchestrator.observer_node, state)
+
+async def investigator_node(state):
+    return await run_blocking(orchestrator.investigator_node, state)
+
+async def interaction_node(state, config):
+    channel = config["configurable"]["answer_channel"]
+    question = state["last_question"]
+    answer = await channel.ask(question)
+    return orchestrator.record_answer(state, question, answer)
+
+async def diagnostician_node(state):
+    return await run_blocking(orchestrator.diagnostician_node, state)
+
+async def forced_decision_node(state):
+    return await run_blocking(orchestrator.forced_decision_node, state)
+
+async def referral_node(state):
+    return await run_blocking(orchestrator.referral_node, state)
+
+
+def create_async_graph():
+    """Compiled graph with async nodes; share one instance across sessions."""
+    return orchestrator.build_workflow({
+        "quality_gate": quality_gate_node,
+        "observer": observer_node,
+        "investigator": investigator_node,
+        "interaction": interaction_node,
+        "diagnostician": diagnostician_node,
+        "forced_decision": forced_decision_node,
+        "referral": referral_node,
+    }).compile()
+
+
+async def run_session(graph, image_path, channel):
+    """Drives one triage session to completion and returns its final state."""
+    try:
+        return await graph.ainvoke(
+            orchestrator.initial_state(image_path),
+            config={"configurable": {"answer_channel": channel}}
+        )
+    finally:
+        await channel.close()
+
+
+async def _scripted_patient(channel, answers):
+    # Demo client: answers each question from a script
+    i = 0
+    while True:
+        question = await channel.next_question()
+        if question is None:
+            return
+        await channel.answer(answers[i % len(answers)])
+        i += 1
+
+
+async def _demo(image_path, sessions):
+    graph = create_async_graph()
+    answers = ["Gradual blurring over the last few months.", "No pain, no flashes or floaters."]
+
+    async def one_session():
+        channel = AnswerChannel()
+        patient = asyncio.create_task(_scripted_patient(channel, answers))
+        final_state = await run_session(graph, image_path, channel)
+        await patient
+        return final_state
+
+    results = await asyncio.gather(*(one_session() for _ in range(sessions)))
+    for i, final_state in enumerate(results):
+        print(f"Session {i}: {final_state['triage_level']}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run concurrent triage sessions on the async runtime")
+    parser.add_argument("image_path")
+    parser.add_argument("--sessions", type=int, default=4)
+    args = parser.parse_args()
+
+    asyncio.run(_demo(args.image_path, args.sessions))
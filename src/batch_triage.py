@@ -0,0 +1,258 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import agent_registry
+agent_observer = agent_registry.lazy("observer")
+agent_diagnostician = agent_registry.lazy("diagnostician")
+
+# Offline batch triage for screening camps.
+# Reads a directory of images or a manifest (CSV/JSONL: image path plus intake
+# answers), runs batched Observer inference per chunk, then the Diagnostician
+# for every record of the chunk concurrently: their triage scoring passes are
+# grouped by the scoring batcher and their referral letters by the shared
+# micro-batcher. (With PREFIX_CACHE_ENABLED=1 or a draft model loaded, the
+# letters are generated one at a time instead.) Results are appended to a JSONL file that doubles as the
+# checkpoint: a rerun skips every record already written. With --retry-errors
+# failed records are processed again; the newest row for an id wins, and the
+# file is compacted afterwards so every id appears exactly once.
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+# Manifest columns that are not intake questions
+RESERVED_COLUMNS = ("id", "image_path", "intake")
+
+BATCH_SIZE = int(os.environ.get("BATCH_TRIAGE_SIZE", 8))
+WORKERS = int(os.environ.get("BATCH_TRIAGE_WORKERS", 4))
+
+
+def _record(image_path, intake=None, record_id=None, base_dir=""):
+    if base_dir and not os.path.isabs(image_path):
+        image_path = os.path.join(base_dir, image_path)
+    return {"id": str(record_id or image_path), "image_path": image_path, "intake": intake or {}}
+
+
+def iter_directory(directory):
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            yield _record(os.path.join(directory, name))
+
+
+def iter_csv(path):
+    """CSV manifest: an image_path column (optional id); every other non-empty column is an intake answer."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            intake = {k: v for k, v in row.items() if k not in RESERVED_COLUMNS and v not in (None, "")}
+            yield _record(row["image_path"], intake, row.get("id"), base_dir)
+
+
+def iter_jsonl(path):
+    """JSONL manifest: {"image_path": ..., "id": ..., "intake": {question: answer}} or flat question keys."""
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            intake = row.get("intake") or {k: v for k, v in row.items() if k not in RESERVED_COLUMNS}
+            yield _record(row["image_path"], intake, row.get("id"), base_dir)
+
+
+def iter_inputs(source):
+    if os.path.isdir(source):
+        return iter_directory(source)
+    if source.lower().endswith(".csv"):
+        return iter_csv(source)
+    if source.lower().endswith((".jsonl", ".ndjson")):
+        return iter_jsonl(source)
+    raise ValueError(f"Unsupported input {source}: expected a directory, .csv or .jsonl")
+
+
+def intake_history(intake):
+    """Formats intake answers like the interview log (Q: ... / A: ...)."""
+    return "\n".join(f"Q: {question}\nA: {answer}" for question, answer in intake.items())
+
+
+def load_checkpoint(output_path, retry_errors=False):
+    """
+    Ids already present in the output (judged by their newest row). A torn
+    last line from a crash is cut off so appending continues from the last
+    complete record.
+    """
+    failed = {}
+    if not os.path.exists(output_path):
+        return set()
+    good_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            good_bytes += len(line)
+            failed[row["id"]] = bool(row.get("error"))
+    if good_bytes < os.path.getsize(output_path):
+        print(f"Checkpoint: discarding a partial record at the end of {output_path}.")
+        with open(output_path, "rb+") as f:
+            f.truncate(good_bytes)
+    return {record_id for record_id, error in failed.items() if not (retry_errors and error)}
+
+
+def compact_output(output_path):
+    """
+    Rewrites the output with one row per id: the newest row wins, in the order
+    ids first appeared. The file is replaced atomically. Returns rows removed.
+    """
+    latest, total = {}, 0
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                total += 1
+                # Assigning to an existing key keeps the id's first position
+                latest[json.loads(line)["id"]] = line if line.endswith("\n") else line + "\n"
+    removed = total - len(latest)
+    if not removed:
+        return 0
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        out.writelines(latest.values())
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, output_path)
+    return removed
+
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _diagnose(record, findings, with_referral):
+    history = intake_history(record["intake"]) or "No intake answers recorded."
+    started = time.perf_counter()
+    # No interview is possible offline: the decision is forced from findings + intake
+    triage_level = agent_diagnostician.classify_triage(findings, history, allow_insufficient=False)
+    referral = agent_diagnostician.generate_referral(findings, history, triage_level=triage_level) if with_referral else None
+    return {
+        "id": record["id"],
+        "image_path": record["image_path"],
+        "intake": record["intake"],
+        "visual_findings": findings,
+        "triage_level": triage_level,
+        "referral_report": referral,
+        "diagnose_s": round(time.perf_counter() - started, 3),
+        "processed_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def _observe_chunk(chunk):
+    """Batched findings for a chunk; falls back per image so one bad file does not fail the chunk."""
+    try:
+        return agent_observer.get_visual_findings_batch([r["image_path"] for r in chunk], batch_size=len(chunk)), {}
+    except Exception:
+        findings, errors = [], {}
+        for record in chunk:
+            try:
+                findings.append(agent_observer.get_visual_findings(record["image_path"]))
+            except Exception as e:
+                findings.append(None)
+                errors[record["id"]] = f"observer: {e}"
+        return findings, errors
+
+
+def run_batch(source, output_path, batch_size=BATCH_SIZE, workers=WORKERS, with_referral=True,
+              retry_errors=False, limit=None):
+    done = load_checkpoint(output_path, retry_errors)
+    if done:
+        print(f"Resuming: {len(done)} records already in {output_path}.")
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    pending = (record for record in iter_inputs(source) if record["id"] not in done)
+    started = time.perf_counter()
+    processed = failed = 0
+
+    with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in _chunks(pending, batch_size):
+            if limit is not None and processed >= limit:
+                break
+            findings, errors = _observe_chunk(chunk)
+
+            futures = {}
+            for record, text in zip(chunk, findings):
+                if record["id"] not in errors:
+                    futures[record["id"]] = pool.submit(_diagnose, record, text, with_referral)
+
+            for record in chunk:
+                if record["id"] in errors:
+                    row = {"id": record["id"], "image_path": record["image_path"], "error": errors[record["id"]]}
+                else:
+                    try:
+                        row = futures[record["id"]].result()
+                    except Exception as e:
+                        row = {"id": record["id"], "image_path": record["image_path"], "error": f"diagnostician: {e}"}
+                failed += "error" in row
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+            # Checkpoint: a chunk is only skipped on resume once it is on disk
+            out.flush()
+            os.fsync(out.fileno())
+            processed += len(chunk)
+            elapsed = time.perf_counter() - started
+            print(f"[Batch] {processed} done ({failed} failed), {processed / elapsed:.2f} images/s")
+
+    if retry_errors:
+        # Retried records were appended after their error rows
+        removed = compact_output(output_path)
+        if removed:
+            print(f"Compacted {output_path}: dropped {removed} superseded rows.")
+
+    elapsed = time.perf_counter() - started
+    print(f"Batch triage finished: {processed} records in {elapsed:.1f}s -> {output_path}")
+    return processed
+
+
+def export_parquet(jsonl_path, parquet_path):
+    """Converts the JSONL results to Parquet (needs pandas with pyarrow or fastparquet)."""
+    import pandas as pd
+    frame = pd.read_json(jsonl_path, lines=True)
+    if "intake" in frame:
+        # Nested dicts have no stable Parquet schema across rows
+        frame["intake"] = frame["intake"].apply(lambda v: json.dumps(v, ensure_ascii=False) if isinstance(v, dict) else v)
+    frame.to_parquet(parquet_path, index=False)
+    print(f"Parquet written to {parquet_path} ({len(frame)} rows)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline batch triage over a directory or manifest")
+    parser.add_argument("input", help="Image directory, or a .csv/.jsonl manifest with image_path + intake answers")
+    parser.add_argument("--output", default="batch_triage_results.jsonl", help="JSONL results (also the checkpoint)")
+    parser.add_argument("--parquet", default=None, help="Also write the results as Parquet when done")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Images per Observer batch")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Concurrent Diagnostician requests")
+    parser.add_argument("--no-referral", action="store_true", help="Only classify; skip the referral letters")
+    parser.add_argument("--retry-errors", action="store_true", help="Reprocess records that failed last time (their rows are replaced)")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after about this many records")
+    args = parser.parse_args()
+
+    run_batch(args.input, args.output, args.batch_size, args.workers, not args.no_referral,
+              args.retry_errors, args.limit)
+    if args.parquet:
+        try:
+            export_parquet(args.output, args.parquet)
+        except ImportError as e:
+            print(f"WARNING: Parquet export needs pyarrow or fastparquet ({e}).")
@@ -0,0 +1,122 @@
+import threading
+import queue
+import time
+from concurrent.futures import Future
+
+# Micro-batching scheduler for the shared text-generation pipeline.
+# Callers submit one prompt each and block on a Future; a single worker thread
+# gathers whatever arrives within the batching window and runs it as one call.
+
+
+class MicroBatcher:
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=20, name="batcher"):
+        """
+        batch_fn(items, **kwargs) must return one result per item, in order.
+        Only requests with identical kwargs are batched together.
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "batches": 0,
+            "batched_requests": 0,
+            "errors": 0,
+            "max_queue_depth": 0,
+            "batch_size_histogram": {},
+        }
+        self._running = True
+        self._worker = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, item, **kwargs):
+        """Queue one item and return a Future for its result."""
+        if not self._running:
+            raise RuntimeError(f"{self.name} has been shut down")
+        future = Future()
+        self._queue.put((item, kwargs, future))
+        with self._lock:
+            self._stats["requests"] += 1
+            depth = self._queue.qsize()
+            if depth > self._stats["max_queue_depth"]:
+                self._stats["max_queue_depth"] = depth
+        return future
+
+    def stats(self):
+        """Snapshot of queue depth and batch-size histogram."""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["batch_size_histogram"] = dict(self._stats["batch_size_histogram"])
+        snapshot["queue_depth"] = self._queue.qsize()
+        if snapshot["batches"]:
+            snapshot["mean_batch_size"] = snapshot["batched_requests"] / snapshot["batches"]
+        else:
+            snapshot["mean_batch_size"] = 0.0
+        return snapshot
+
+    def shutdown(self):
+        self._running = False
+        self._queue.put(None)
+        self._worker.join(timeout=5)
+
+    def _collect(self):
+        """Block for the first request, then gather until the window closes."""
+        first = self._queue.get()
+        if first is None:
+            return None
+        pending = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is None:
+                self._running = False
+                break
+            pending.append(entry)
+        return pending
+
+    def _loop(self):
+        while self._running:
+            pending = self._collect()
+            if pending is None:
+                break
+
+            # Group by generation kwargs, preserving arrival order within a group
+            groups = {}
+            for item, kwargs, future in pending:
+                key = tuple(sorted(kwargs.items()))
+                groups.setdefault(key, []).append((item, future))
+
+            for key, entries in groups.items():
+                self._run_group(dict(key), entries)
+
+    def _run_group(self, kwargs, entries):
+        items = [item for item, _ in entries]
+        with self._lock:
+            self._stats["batches"] += 1
+            self._stats["batched_requests"] += len(items)
+            histogram = self._stats["batch_size_histogram"]
+            histogram[len(items)] = histogram.get(len(items), 0) + 1
+        try:
+            results = self.batch_fn(items, **kwargs)
+            if len(results) != len(items):
+                raise RuntimeError(
+                    f"{self.name}: batch_fn returned {len(results)} results for {len(items)} items"
+                )
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            for _, future in entries:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(entries, results):
+            future.set_result(result)
@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import agent_registry
+from agent_investigator import MockPipeline
+from agent_diagnostician import REFERRAL_INSTRUCTIONS, get_scorer_stats
+
+# End-to-end benchmark for a triage session.
+# Drives the LangGraph workflow (orchestrator.build_workflow) and, optionally,
+# the Gradio handlers with scripted patient answers instead of input(). The
+# models are replaced by a deterministic stub with configurable latency, or the
+# investigator can run a small local HF model. Results are written as JSON so
+# runs on the same CPU box can be compared between commits.
+
+SCRIPTED_ANSWERS = [
+    "It started suddenly two days ago and it is getting worse.",
+    "Yes, I have had diabetes for about ten years and my sugar is often high.",
+    "I see dark floaters and some flashes of light in that eye.",
+]
+
+STUB_QUESTION = "Is the vision loss sudden or gradual?"
+STUB_REFERRAL = (
+    "REFERRAL DIAGNOSIS: Proliferative Diabetic Retinopathy. TRIAGE: Red (Emergency). "
+    "Refer to an ophthalmologist within 24 hours for laser treatment assessment."
+)
+
+GRAPH_NODES = ["quality_gate", "observer", "investigator", "interaction", "diagnostician", "forced_decision", "referral"]
+
+
+class StubPipeline(MockPipeline):
+    """
+    Deterministic stand-in for the text-generation pipeline.
+    Each call sleeps prefill_ms + per_token_ms * tokens (once per batch, like a
+    real batched forward pass). The triage decision asks for more information
+    until the history holds `turns` answers. Unlike MockPipeline it goes through
+    the agents' real code paths (micro-batcher, triage parsing).
+    """
+
+    def __init__(self, prefill_ms=50.0, per_token_ms=5.0, turns=2):
+        super().__init__(task="text-generation")
+        self.prefill_ms = prefill_ms
+        self.per_token_ms = per_token_ms
+        self.turns = turns
+        self.tokens = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _reply(self, chat, max_new_tokens):
+        prompt = chat[-1]["content"] if isinstance(chat[-1]["content"], str) else str(chat[-1]["content"])
+        if max_new_tokens <= 4:
+            # Answers seen so far, whether raw or folded into the history summary
+            answered = sum(answer[:40] in prompt for answer in SCRIPTED_ANSWERS)
+            return "RED" if answered >= self.turns else "INSUFFICIENT"
+        if REFERRAL_INSTRUCTIONS in prompt:
+            return STUB_REFERRAL
+        return STUB_QUESTION
+
+    def __call__(self, messages, max_new_tokens=512, **kwargs):
+        batch = messages if messages and isinstance(messages[0], list) else [messages]
+        texts = [self._reply(chat, max_new_tokens) for chat in batch]
+        tokens = max(len(text.split()) for text in texts)
+        time.sleep((self.prefill_ms + self.per_token_ms * tokens) / 1000.0)
+        with self._lock:
+            self.calls += 1
+            self.tokens += sum(len(text.split()) for text in texts)
+        outputs = [[{"generated_text": text}] for text in texts]
+        return outputs if batch is messages else outputs[0]
+
+
+class TokenCounter:
+    """Counts generated tokens of a real model via a forward hook (one token per row per forward)."""
+
+    def __init__(self, model):
+        self.tokens = 0
+        self._lock = threading.Lock()
+        model.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, output):
+        logits = getattr(output, "logits", None)
+        if logits is not None:
+            with self._lock:
+                self.tokens += logits.shape[0]
+
+
+def install_stub_models(observer_ms, prefill_ms, per_token_ms, turns, model_id=None, draft_model_id=None):
+    """
+    Swaps the agents' models for the stub (or a small local model for the
+    investigator/diagnostician, optionally with a draft model for assisted
+    decoding). Returns an object with a .tokens counter.
+    """
+    observer = agent_registry.get_agent("observer")
+    investigator = agent_registry.get_agent("investigator")
+
+    def stub_findings(*args, **kwargs):
+        time.sleep(observer_ms / 1000.0)
+        return observer.MOCK_FINDINGS
+
+    # Stub Observer: MOCK_MODE preprocessing, fixed-latency generation
+    observer.MOCK_MODE = True
+    observer.get_visual_findings = stub_findings
+    observer.generate_findings = stub_findings
+
+    if model_id:
+        from transformers import pipeline
+        local_pipe = pipeline("text-generation", model=model_id, device="cpu")
+        local_pipe.tokenizer.padding_side = "left"
+        if local_pipe.tokenizer.pad_token is None:
+            local_pipe.tokenizer.pad_token = local_pipe.tokenizer.eos_token
+        investigator.pipe = local_pipe
+        counter = TokenCounter(local_pipe.model)
+        if draft_model_id:
+            from speculative_decoding import load_draft
+            investigator.draft = load_draft(local_pipe.model, local_pipe.tokenizer, draft_model_id)
+        return counter
+
+    stub = StubPipeline(prefill_ms, per_token_ms, turns)
+    investigator.pipe = stub
+    return stub
+
+
+def _timed(name, fn, samples, lock):
+    def node(state, *args):
+        started = time.perf_counter()
+        try:
+            return fn(state, *args)
+        finally:
+            with lock:
+                samples[name].append(time.perf_counter() - started)
+    return node
+
+
+def scripted_interaction_node(state):
+    # Replaces orchestrator.interaction_node: answers come from SCRIPTED_ANSWERS, not input()
+    import orchestrator
+    turn = len(state["history_log"])
+    answer = SCRIPTED_ANSWERS[turn % len(SCRIPTED_ANSWERS)]
+    return orchestrator.record_answer(state, state["last_question"], answer)
+
+
+def build_benchmark_graph(samples, lock):
+    import orchestrator
+    nodes = {
+        "quality_gate": orchestrator.quality_gate_node,
+        "observer": orchestrator.observer_node,
+        "investigator": orchestrator.investigator_node,
+        "interaction": scripted_interaction_node,
+        "diagnostician": orchestrator.diagnostician_node,
+        "forced_decision": orchestrator.forced_decision_node,
+        "referral": orchestrator.referral_node,
+    }
+    return orchestrator.build_workflow({name: _timed(name, fn, samples, lock) for name, fn in nodes.items()}).compile()
+
+
+def run_graph_sessions(image_path, sessions, concurrency, samples, lock):
+    import orchestrator
+    app = build_benchmark_graph(samples, lock)
+
+    def session(_):
+        started = time.perf_counter()
+        final_state = app.invoke(orchestrator.initial_state(image_path))
+        with lock:
+            samples["session"].append(time.perf_counter() - started)
+        return final_state["triage_level"]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(session, range(sessions)))
+
+
+class _Request:
+    """Minimal stand-in for gr.Request: the handlers only read session_hash."""
+
+    def __init__(self, session_hash):
+        self.session_hash = session_hash
+
+
+def _drain(generator, name, samples, lock):
+    started = time.perf_counter()
+    first = None
+    last = None
+    for last in generator:
+        if first is None:
+            first = time.perf_counter() - started
+    with lock:
+        samples[name].append(time.perf_counter() - started)
+        samples[name + "_first_yield"].append(first if first is not None else 0.0)
+    return last
+
+
+def run_gradio_sessions(image_path, sessions, concurrency, samples, lock):
+    import ui_gradio
+
+    def session(i):
+        request = _Request(f"bench-{i}")
+        started = time.perf_counter()
+        _drain(ui_gradio.process_first_turn(image_path, request), "first_turn", samples, lock)
+        report = _drain(ui_gradio.process_second_turn(image_path, SCRIPTED_ANSWERS[0], request), "second_turn", samples, lock)
+        ui_gradio.reset_conversation(request)
+        with lock:
+            samples["session"].append(time.perf_counter() - started)
+        return report
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(session, range(sessions)))
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        # Nearest-rank percentile
+        index = max(0, math.ceil(q / 100.0 * len(ordered)) - 1)
+        return round(ordered[index] * 1000.0, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000.0, 3),
+        "p50_ms": pick(50),
+        "p95_ms": pick(95),
+        "p99_ms": pick(99),
+        "max_ms": round(ordered[-1] * 1000.0, 3),
+    }
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Windows: psutil reports the peak working set
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(mode="graph", sessions=20, concurrency=1, image_path="benchmark.jpg",
+                  observer_ms=200.0, prefill_ms=50.0, per_token_ms=5.0, turns=2, model_id=None,
+                  draft_model_id=None):
+    if not os.path.exists(image_path):
+        # The quality gate reads the image even though the stub Observer does not
+        from fundus_preprocess import _synthetic_fundus
+        with open(image_path, "wb") as f:
+            f.write(_synthetic_fundus().read())
+    counter = install_stub_models(observer_ms, prefill_ms, per_token_ms, turns, model_id, draft_model_id)
+    samples = {name: [] for name in GRAPH_NODES + ["session", "first_turn", "first_turn_first_yield",
+                                                   "second_turn", "second_turn_first_yield"]}
+    lock = threading.Lock()
+
+    started = time.perf_counter()
+    if mode == "graph":
+        run_graph_sessions(image_path, sessions, concurrency, samples, lock)
+    else:
+        run_gradio_sessions(image_path, sessions, concurrency, samples, lock)
+    elapsed = time.perf_counter() - started
+
+    investigator = agent_registry.get_agent("investigator")
+    speculative = investigator.get_speculative_stats()
+    # The forward hook sees one token per verification step; accepted draft tokens come on top
+    tokens = counter.tokens + speculative.get("accepted", 0)
+    return {
+        "mode": mode,
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "sessions": sessions,
+            "concurrency": concurrency,
+            "model": model_id or "stub",
+            "draft_model": draft_model_id if model_id else None,
+            "observer_ms": observer_ms,
+            "prefill_ms": prefill_ms,
+            "per_token_ms": per_token_ms,
+            "turns": turns,
+        },
+        "wall_s": round(elapsed, 3),
+        "sessions_per_s": round(sessions / elapsed, 3) if elapsed > 0 else None,
+        "tokens_generated": tokens,
+        "tokens_per_s": round(tokens / elapsed, 1) if elapsed > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "latency": {name: percentiles(values) for name, values in samples.items() if values},
+        "batcher": investigator.get_batcher_stats(),
+        "scorer": get_scorer_stats(),
+        "speculative": speculative,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end triage session benchmark")
+    parser.add_argument("--mode", choices=["graph", "gradio"], default="graph",
+                        help="Drive the LangGraph workflow or the Gradio handlers")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--image", default="benchmark.jpg",
+                        help="Image for the quality gate (unused by the stub Observer); a synthetic fundus is written if missing")
+    parser.add_argument("--observer-ms", type=float, default=200.0, help="Stub Observer latency")
+    parser.add_argument("--prefill-ms", type=float, default=50.0, help="Stub pipeline latency per call")
+    parser.add_argument("--per-token-ms", type=float, default=5.0, help="Stub pipeline latency per token")
+    parser.add_argument("--turns", type=int, default=2,
+                        help=f"Answers before the stub triage decides (at most {len(SCRIPTED_ANSWERS)})")
+    parser.add_argument("--model", default=None, help="Small local HF model for Agents B/C instead of the stub")
+    parser.add_argument("--draft-model", default=None,
+                        help="Draft model for assisted decoding with --model (e.g. a smaller model of the same family)")
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.mode, args.sessions, args.concurrency, args.image,
+        args.observer_ms, args.prefill_ms, args.per_token_ms, args.turns, args.model, args.draft_model
+    )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for name, stats in results["latency"].items():
+        if stats["count"]:
+            print(f"{name:>24}: p50 {stats['p50_ms']:.1f}ms  p95 {stats['p95_ms']:.1f}ms  p99 {stats['p99_ms']:.1f}ms")
+    print(f"{results['sessions_per_s']} sessions/s, {results['tokens_generated']} tokens, "
+          f"peak RSS {results['peak_rss_mb']}MB -> {args.output}")
@@ -0,0 +1,130 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from quantized_weights import find_artifact, load_quantized
+
+# CPU inference backends for hosts without CUDA.
+#   cpu-int8  dynamic int8 quantization of the language model's Linear layers
+#             (or the pre-quantized artifact from export_models.py when present)
+#   cpu-bf16  bfloat16 weights where the CPU has native bf16, float32 otherwise
+#   onnx      ONNX Runtime through optimum (optional dependency)
+# Threads are pinned once per process; generation throughput is tracked per backend.
+
+CPU_BACKENDS = ("cpu-int8", "cpu-bf16", "onnx")
+# 0 = one thread per CPU available to this process
+CPU_THREADS = int(os.environ.get("CPU_THREADS", 0))
+
+_threads_configured = False
+_stats_lock = threading.Lock()
+_throughput = {}
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def configure_threads(num_threads=CPU_THREADS):
+    """Sets intra-op threads to the CPUs we may use; inter-op work is mostly serial in generate()."""
+    global _threads_configured
+    import torch
+    if _threads_configured:
+        return torch.get_num_threads()
+    threads = num_threads or available_cpus()
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only allowed before the first parallel op
+        pass
+    _threads_configured = True
+    print(f"[CPU] Using {threads} intra-op threads.")
+    return threads
+
+
+def bf16_supported():
+    """True when the CPU has native bf16 (AVX512-BF16 or AMX); emulated bf16 is slower than fp32."""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def _language_model(model):
+    # PaliGemma keeps the Gemma decoder under .language_model (.model.language_model in newer transformers)
+    for path in ("language_model", "model.language_model"):
+        try:
+            return model.get_submodule(path)
+        except AttributeError:
+            continue
+    return model
+
+
+def load_cpu_int8(model_cls, model_id):
+    import torch
+    configure_threads()
+    artifact = find_artifact(model_id)
+    if artifact:
+        print(f"[CPU] Loading pre-quantized artifact from {artifact}.")
+        return load_quantized(model_cls, artifact)
+
+    model = model_cls.from_pretrained(model_id, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+    model.eval()
+    # Dynamic quantization: int8 weights, activations quantized on the fly per batch.
+    # The vision tower stays float32; the decoder dominates generation time.
+    torch.ao.quantization.quantize_dynamic(_language_model(model), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def load_cpu_bf16(model_cls, model_id):
+    import torch
+    configure_threads()
+    dtype = torch.bfloat16 if bf16_supported() else torch.float32
+    if dtype is torch.float32:
+        print("[CPU] No native bf16 on this CPU, using float32.")
+    model = model_cls.from_pretrained(model_id, torch_dtype=dtype, low_cpu_mem_usage=True)
+    model.eval()
+    return model
+
+
+def load_onnx(model_id):
+    """ONNX Runtime model via optimum; raises ImportError if optimum[onnxruntime] is missing."""
+    from optimum.onnxruntime import ORTModelForVision2Seq
+    configure_threads()
+    return ORTModelForVision2Seq.from_pretrained(model_id, export=True)
+
+
+def load(backend, model_cls, model_id):
+    if backend == "cpu-int8":
+        return load_cpu_int8(model_cls, model_id)
+    if backend == "cpu-bf16":
+        return load_cpu_bf16(model_cls, model_id)
+    if backend == "onnx":
+        return load_onnx(model_id)
+    raise ValueError(f"Unknown CPU backend: {backend}")
+
+
+def record_throughput(backend, new_tokens, elapsed):
+    """Accumulates generated tokens and time for a backend; returns this call's tokens/sec."""
+    with _stats_lock:
+        stats = _throughput.setdefault(backend, {"calls": 0, "tokens": 0, "seconds": 0.0})
+        stats["calls"] += 1
+        stats["tokens"] += new_tokens
+        stats["seconds"] += elapsed
+    return new_tokens / elapsed if elapsed > 0 else 0.0
+
+
+def throughput_stats():
+    with _stats_lock:
+        return {
+            backend: dict(stats, tokens_per_s=stats["tokens"] / stats["seconds"] if stats["seconds"] else 0.0)
+            for backend, stats in _throughput.items()
+        }
+
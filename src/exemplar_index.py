@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import time
+import zlib
+import threading
+import numpy as np
+
+# Retrieval index over the labelled few-shot exemplars (data/few_shot_examples.json).
+# The build step embeds every exemplar once with a hashed bag of words and
+# character trigrams and writes the matrix to a .npy file. At runtime the matrix
+# is memory-mapped and a query is one small matrix-vector product, so pulling
+# the top-k similar cases into a prompt costs well under a millisecond and
+# needs no model call.
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+EXAMPLES_PATH = os.path.join(DATA_DIR, "few_shot_examples.json")
+INDEX_PATH = os.path.join(DATA_DIR, "exemplar_index.npy")
+METADATA_PATH = os.path.join(DATA_DIR, "exemplar_index.json")
+
+EMBEDDING_DIM = 512
+EXEMPLAR_TOP_K = int(os.environ.get("EXEMPLAR_TOP_K", 3))
+
+LABEL_NAMES = {
+    "N": "Normal",
+    "D": "Diabetic Retinopathy",
+    "G": "Glaucoma",
+    "C": "Cataract",
+    "A": "Age-related Macular Degeneration",
+    "H": "Hypertensive Retinopathy",
+    "M": "Pathological Myopia",
+    "O": "Other abnormality",
+}
+
+# Extra vocabulary per label so free-text findings match the short ODIR keywords
+LABEL_TERMS = {
+    "N": "normal fundus healthy clear optic disc macula",
+    "D": "diabetic retinopathy microaneurysms hemorrhages hard exudates cotton wool spots neovascularization",
+    "G": "glaucoma optic disc cupping cup-to-disc ratio optic nerve",
+    "C": "cataract lens opacity hazy blurred image",
+    "A": "age-related macular degeneration drusen macula pigment",
+    "H": "hypertensive retinopathy arteriolar narrowing av nicking flame hemorrhages",
+    "M": "pathological myopia tessellated fundus peripapillary atrophy",
+    "O": "other abnormality",
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _features(text):
+    words = _TOKEN_RE.findall(text.lower())
+    for word in words:
+        yield "w:" + word, 1.0
+        padded = f"#{word}#"
+        for i in range(len(padded) - 2):
+            yield "c:" + padded[i:i + 3], 0.5
+
+
+def embed(text, dim=EMBEDDING_DIM):
+    """Hashed bag-of-words + character-trigram embedding, L2-normalised."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, weight in _features(text):
+        h = zlib.crc32(feature.encode())
+        # Signed hashing keeps collisions from only adding up
+        vector[h % dim] += weight if (h >> 31) & 1 else -weight
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def _exemplar_text(example):
+    label = example["label"]
+    return f"{LABEL_NAMES.get(label, label)} {example.get('keywords') or ''} {LABEL_TERMS.get(label, '')}"
+
+
+def build_index(examples_path=EXAMPLES_PATH, index_path=INDEX_PATH, metadata_path=METADATA_PATH):
+    """Embeds every exemplar and writes the .npy matrix plus a JSON metadata sidecar."""
+    with open(examples_path, "r", encoding="utf-8") as f:
+        examples = json.load(f)
+
+    metadata = []
+    for label, items in examples.items():
+        for example in items:
+            metadata.append({
+                "label": label,
+                "label_name": LABEL_NAMES.get(label, label),
+                "keywords": str(example.get("keywords") or "").replace("，", ", "),
+                "image_path": example.get("image_path"),
+                "text": _exemplar_text(example),
+            })
+
+    matrix = np.stack([embed(item["text"]) for item in metadata]) if metadata else np.zeros((0, EMBEDDING_DIM), np.float32)
+    np.save(index_path, matrix.astype(np.float32))
+    with open(metadata_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    print(f"Exemplar index: {len(metadata)} exemplars -> {index_path}")
+    return len(metadata)
+
+
+class ExemplarIndex:
+    def __init__(self, index_path=INDEX_PATH, metadata_path=METADATA_PATH):
+        # Memory-mapped: nothing is copied or re-parsed per request
+        self.matrix = np.load(index_path, mmap_mode="r")
+        with open(metadata_path, "r", encoding="utf-8") as f:
+            self.metadata = json.load(f)
+
+    def search(self, text, k=EXEMPLAR_TOP_K):
+        """Top-k exemplars most similar to text, best first, with their cosine score."""
+        if not len(self.metadata) or k <= 0:
+            return []
+        scores = self.matrix @ embed(text, self.matrix.shape[1])
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [dict(self.metadata[i], score=float(scores[i])) for i in top]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Shared index, built on first use if the build step has not been run."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            try:
+                if not (os.path.exists(INDEX_PATH) and os.path.exists(METADATA_PATH)):
+                    build_index()
+                _index = ExemplarIndex()
+            except (OSError, ValueError) as e:
+                print(f"WARNING: Exemplar index unavailable ({e}).")
+                return None
+    return _index
+
+
+def similar_cases(text, k=EXEMPLAR_TOP_K):
+    index = get_index()
+    if index is None:
+        return []
+    return index.search(text, k)
+
+
+def format_similar_cases(text, k=EXEMPLAR_TOP_K):
+    """Prompt block listing the top-k labelled reference cases, or '' if none."""
+    cases = similar_cases(text, k)
+    if not cases:
+        return ""
+    lines = [f"- {case['label_name']}: {case['keywords']}" for case in cases]
+    return "Similar labelled reference cases (ODIR-5K):\n" + "\n".join(lines)
+
+
+if __name__ == "__main__":
+    build_index()
+    index = ExemplarIndex()
+    query = "Severe diabetic retinopathy with microaneurysms and hard exudates detected. Optic disc cup-to-disc ratio is 0.6."
+    index.search(query)
+    start = time.perf_counter()
+    for _ in range(1000):
+        results = index.search(query)
+    # 1000 queries: total seconds == milliseconds per query
+    per_query_ms = time.perf_counter() - start
+    print(f"Query cost: {per_query_ms:.3f} ms")
+    for case in results:
+        print(f"  {case['score']:.3f} {case['label_name']}: {case['keywords']}")
@@ -0,0 +1,57 @@
+import os
+import argparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from quantized_weights import QUANTIZED_BITS, QUANTIZED_MODELS_DIR, artifact_dir, export_quantized
+
+# Exports CPU-friendly int8/int4 safetensors artifacts for both models.
+# Run once after download_models.py (needs enough RAM to hold one model in float32);
+# the agents pick the artifacts up automatically on hosts without CUDA.
+
+OBSERVER_MODEL_ID = "google/paligemma-3b-mix-224"
+INVESTIGATOR_MODEL_ID = "google/gemma-2-2b-it"
+
+
+def export_observer(bits, root):
+    import torch
+    from transformers import PaliGemmaForConditionalGeneration, PaliGemmaProcessor
+
+    out_dir = artifact_dir(OBSERVER_MODEL_ID, bits, root)
+    print(f"Exporting {OBSERVER_MODEL_ID} (int{bits})...")
+    model = PaliGemmaForConditionalGeneration.from_pretrained(
+        OBSERVER_MODEL_ID, torch_dtype=torch.float32, low_cpu_mem_usage=True
+    )
+    export_quantized(model, out_dir, bits)
+    PaliGemmaProcessor.from_pretrained(OBSERVER_MODEL_ID).save_pretrained(out_dir)
+
+
+def export_investigator(bits, root):
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    out_dir = artifact_dir(INVESTIGATOR_MODEL_ID, bits, root)
+    print(f"Exporting {INVESTIGATOR_MODEL_ID} (int{bits})...")
+    model = AutoModelForCausalLM.from_pretrained(
+        INVESTIGATOR_MODEL_ID, torch_dtype=torch.float32, low_cpu_mem_usage=True
+    )
+    export_quantized(model, out_dir, bits)
+    AutoTokenizer.from_pretrained(INVESTIGATOR_MODEL_ID).save_pretrained(out_dir)
+
+
+EXPORTERS = {"observer": export_observer, "investigator": export_investigator}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export quantized, memory-mappable model artifacts")
+    parser.add_argument("--bits", type=int, choices=[4, 8], default=QUANTIZED_BITS)
+    parser.add_argument("--out", default=QUANTIZED_MODELS_DIR, help="Artifact root (QUANTIZED_MODELS_DIR)")
+    parser.add_argument("--models", nargs="+", choices=list(EXPORTERS), default=list(EXPORTERS))
+    args = parser.parse_args()
+
+    if not os.environ.get("HF_TOKEN"):
+        print("WARNING: HF_TOKEN not found! Gated models may fail to load.")
+    for name in args.models:
+        EXPORTERS[name](args.bits, args.out)
+    print(f"Artifacts written to {os.path.abspath(args.out)}. Set QUANTIZED_BITS={args.bits} to load them.")
@@ -0,0 +1,142 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+import time
+from dotenv import load_dotenv
+import telemetry
+
+load_dotenv()
+
+# Content-addressed cache for Agent A (Observer) findings.
+# Keys hash the decoded pixel data (not the file path or bytes on disk), so a
+# re-uploaded photo hits the cache even if Gradio stored it under a new name.
+
+CACHE_ENABLED = os.environ.get("FINDINGS_CACHE_ENABLED", "1") == "1"
+CACHE_PATH = os.environ.get(
+    "FINDINGS_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache", "findings_cache.sqlite")
+)
+CACHE_MAX_MB = float(os.environ.get("FINDINGS_CACHE_MAX_MB", 64))
+
+
+def image_digest(image):
+    """SHA-256 of the decoded pixels (mode and size included)."""
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def make_key(digest, model_id, prompt, generation_params):
+    params = json.dumps(generation_params, sort_keys=True)
+    return hashlib.sha256(f"{digest}|{model_id}|{prompt}|{params}".encode()).hexdigest()
+
+
+class FindingsCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=int(CACHE_MAX_MB * 1024 * 1024)):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS findings (
+                key TEXT PRIMARY KEY,
+                findings TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_findings_last_access ON findings(last_access)")
+        self._conn.commit()
+
+        row = self._conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM findings").fetchone()
+        self._total_bytes = row[0]
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT findings FROM findings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                telemetry.increment("cache_lookups_total", cache="findings", result="miss")
+                return None
+            self._conn.execute("UPDATE findings SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self._stats["hits"] += 1
+            telemetry.increment("cache_lookups_total", cache="findings", result="hit")
+            return row[0]
+
+    def put(self, key, findings):
+        size = len(key) + len(findings.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size_bytes FROM findings WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._total_bytes -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO findings (key, findings, size_bytes, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, findings, size, now, now)
+            )
+            self._total_bytes += size
+            self._stats["writes"] += 1
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self):
+        # Drop least recently used entries until we are back under the size bound
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size_bytes FROM findings ORDER BY last_access ASC LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM findings WHERE key = ?", (key,))
+                self._total_bytes -= size
+                self._stats["evictions"] += 1
+                if self._total_bytes <= self.max_bytes:
+                    break
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            entries = self._conn.execute("SELECT COUNT(*) FROM findings").fetchone()[0]
+        lookups = snapshot["hits"] + snapshot["misses"]
+        snapshot["hit_rate"] = snapshot["hits"] / lookups if lookups else 0.0
+        snapshot["entries"] = entries
+        snapshot["size_bytes"] = self._total_bytes
+        snapshot["max_bytes"] = self.max_bytes
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM findings")
+            self._conn.commit()
+            self._total_bytes = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Shared cache instance, or None when disabled via FINDINGS_CACHE_ENABLED=0."""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = FindingsCache()
+            except sqlite3.Error as e:
+                print(f"WARNING: Findings cache unavailable ({e}). Continuing without it.")
+                return None
+    return _cache
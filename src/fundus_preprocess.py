@@ -0,0 +1,267 @@
+import os
+import io
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Fast decode + preprocessing for fundus photographs.
+# ODIR-style captures are several megapixels with a wide black border around the
+# circular fundus, and the generic processor decodes them at full resolution
+# just to resize to 224x224. Here JPEGs are decoded at reduced scale (draft
+# mode, DCT scaling inside libjpeg), the fundus disc is cropped from the border,
+# crop + resize is a single resampling call, and normalisation is a vectorised
+# multiply-add into a preallocated float32 buffer. The prompt's token ids are
+# computed once per prompt, so the processor is not called per image.
+# The last few decodes are kept, so the quality gate and the Observer share one
+# decode of each upload.
+
+FAST_PREPROCESS = os.environ.get("FAST_PREPROCESS", "1") == "1"
+# Pixels darker than this (max over channels, 0-255) count as border
+BORDER_THRESHOLD = 20
+# Version tag for cache keys: findings from cropped inputs differ from the full frame
+PREPROCESS_VERSION = "fundus-v1"
+# Decoded images kept for reuse (~1-3 MB each at draft scale)
+DECODE_CACHE_ENTRIES = int(os.environ.get("DECODE_CACHE_ENTRIES", 4))
+
+_decoded = OrderedDict()
+_decoded_lock = threading.Lock()
+
+
+class ImageSpec:
+    """Target size and normalisation taken from a (SigLIP) image processor."""
+
+    def __init__(self, size=224, mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5), rescale=1 / 255.0,
+                 resample=Image.BICUBIC):
+        self.size = size
+        self.resample = resample
+        mean = np.asarray(mean, dtype=np.float32)
+        std = np.asarray(std, dtype=np.float32)
+        # (x * rescale - mean) / std == x * scale + offset; 224px SigLIP: x / 127.5 - 1
+        self.scale = (rescale / std).reshape(3, 1, 1)
+        self.offset = (-mean / std).reshape(3, 1, 1)
+
+    @classmethod
+    def from_processor(cls, processor):
+        image_processor = processor.image_processor
+        size = image_processor.size
+        return cls(
+            size=size.get("height", size.get("shortest_edge", 224)) if isinstance(size, dict) else size,
+            mean=image_processor.image_mean,
+            std=image_processor.image_std,
+            rescale=image_processor.rescale_factor,
+            resample=Image.Resampling(int(getattr(image_processor, "resample", Image.BICUBIC))),
+        )
+
+
+class BufferPool:
+    """Reusable (3, size, size) float32 buffers; a buffer is held until its image has been generated."""
+
+    def __init__(self, shape, max_free=8):
+        self.shape = shape
+        self.max_free = max_free
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return np.empty(self.shape, dtype=np.float32)
+
+    def release(self, buffer):
+        if buffer is None:
+            return
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
+
+
+def decode(image_path, size=224):
+    """
+    Decodes at the smallest JPEG scale (1/2, 1/4, 1/8) that still leaves >= 2x
+    the target size. Recent results are reused while the file is unchanged;
+    the returned image is shared, so callers must not modify it in place.
+    """
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image not found at {image_path}")
+    st = os.stat(image_path)
+    key = (os.path.abspath(image_path), st.st_ino, st.st_size, st.st_mtime_ns, size)
+    with _decoded_lock:
+        image = _decoded.get(key)
+        if image is not None:
+            _decoded.move_to_end(key)
+            return image
+
+    image = _decode_file(image_path, size)
+    if DECODE_CACHE_ENTRIES > 0:
+        with _decoded_lock:
+            _decoded[key] = image
+            while len(_decoded) > DECODE_CACHE_ENTRIES:
+                _decoded.popitem(last=False)
+    return image
+
+
+def _decode_file(image_path, size):
+    image = Image.open(image_path)
+    if image.format == "JPEG":
+        image.draft("RGB", (size * 2, size * 2))
+    return image.convert("RGB")
+
+
+def fundus_box(image, threshold=BORDER_THRESHOLD):
+    """Square box around the fundus disc, found on a small thumbnail; the full frame if none."""
+    width, height = image.size
+    probe = image.copy()
+    probe.thumbnail((128, 128), Image.NEAREST)
+    mask = np.asarray(probe).max(axis=2) > threshold
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return (0, 0, width, height)
+
+    sx, sy = width / probe.size[0], height / probe.size[1]
+    top, bottom = rows[0] * sy, (rows[-1] + 1) * sy
+    left, right = cols[0] * sx, (cols[-1] + 1) * sx
+    # Square around the disc centre; may extend past the frame (filled with black by the resampler)
+    side = max(bottom - top, right - left)
+    cx, cy = (left + right) / 2, (top + bottom) / 2
+    return (cx - side / 2, cy - side / 2, cx + side / 2, cy + side / 2)
+
+
+def to_pixels(image, spec, out=None, crop=True):
+    """Crop + resize + normalise into out (3, size, size) float32, allocated if None."""
+    box = fundus_box(image) if crop else (0, 0) + image.size
+    if box[0] < 0 or box[1] < 0 or box[2] > image.size[0] or box[3] > image.size[1]:
+        # Pad to the square box first so the disc keeps its aspect ratio
+        side = int(round(box[2] - box[0]))
+        canvas = Image.new("RGB", (side, side))
+        canvas.paste(image, (int(round(-box[0])), int(round(-box[1]))))
+        image, box = canvas, (0, 0, side, side)
+    resized = image.resize((spec.size, spec.size), spec.resample, box=box)
+
+    if out is None:
+        out = np.empty((3, spec.size, spec.size), dtype=np.float32)
+    # HWC uint8 -> CHW float32 without an intermediate float copy
+    np.multiply(np.asarray(resized).transpose(2, 0, 1), spec.scale, out=out, casting="unsafe")
+    out += spec.offset
+    return out
+
+
+class FundusPreprocessor:
+    """Per-processor state: image spec, cached prompt token ids and the buffer pool."""
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.spec = ImageSpec.from_processor(processor)
+        self.pool = BufferPool((3, self.spec.size, self.spec.size))
+        self._text_inputs = {}
+        self._lock = threading.Lock()
+
+    def text_inputs(self, prompt):
+        """input_ids/attention_mask for prompt; they do not depend on the image, so they are built once."""
+        with self._lock:
+            cached = self._text_inputs.get(prompt)
+            if cached is None:
+                blank = Image.new("RGB", (self.spec.size, self.spec.size))
+                inputs = self.processor(text=prompt, images=blank, return_tensors="pt")
+                cached = self._text_inputs[prompt] = (inputs["input_ids"], inputs["attention_mask"])
+        return cached
+
+    def decode(self, image_path):
+        return decode(image_path, self.spec.size)
+
+    def inputs(self, image, prompt):
+        """Model inputs for one decoded image. Hand the returned buffer back via release()."""
+        import torch
+        buffer = to_pixels(image, self.spec, out=self.pool.acquire())
+        input_ids, attention_mask = self.text_inputs(prompt)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "pixel_values": torch.from_numpy(buffer).unsqueeze(0),
+        }, buffer
+
+    def batch_inputs(self, images, prompt, out=None):
+        """Batched inputs; all rows share the same prompt, so no padding is needed."""
+        import torch
+        size = self.spec.size
+        if out is None or out.shape[0] < len(images):
+            out = np.empty((len(images), 3, size, size), dtype=np.float32)
+        for i, image in enumerate(images):
+            to_pixels(image, self.spec, out=out[i])
+        input_ids, attention_mask = self.text_inputs(prompt)
+        return {
+            "input_ids": input_ids.expand(len(images), -1),
+            "attention_mask": attention_mask.expand(len(images), -1),
+            "pixel_values": torch.from_numpy(out[:len(images)]),
+        }, out
+
+    def release(self, buffer):
+        self.pool.release(buffer)
+
+
+def _synthetic_fundus(width=3000, height=2000):
+    """JPEG bytes of a fundus-like frame: orange disc with dark vessels on a black border."""
+    from PIL import ImageDraw
+    yy, xx = np.mgrid[0:height, 0:width]
+    radius = height * 0.46
+    disc = (xx - width / 2) ** 2 + (yy - height / 2) ** 2 <= radius ** 2
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[disc] = (190, 90, 40)
+    image = Image.fromarray(frame)
+    # Vessels fanning out from the optic disc, so the frame has in-focus detail
+    draw = ImageDraw.Draw(image)
+    cx, cy = width * 0.42, height / 2
+    for angle in np.linspace(0, 2 * np.pi, 12, endpoint=False):
+        end = (cx + np.cos(angle) * radius * 0.9, cy + np.sin(angle) * radius * 0.9)
+        draw.line([(cx, cy), end], fill=(120, 30, 20), width=max(2, width // 300))
+    draw.ellipse([cx - radius * 0.08, cy - radius * 0.08, cx + radius * 0.08, cy + radius * 0.08], fill=(240, 200, 120))
+    image = Image.fromarray(np.where(disc[..., None], np.asarray(image), 0).astype(np.uint8))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    buffer.seek(0)
+    return buffer
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    # Microbenchmark: full decode + generic resize/normalise vs. the fast path
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), "visionlink_synthetic_fundus.jpg")
+        with open(path, "wb") as f:
+            f.write(_synthetic_fundus().read())
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    spec = ImageSpec()
+
+    def baseline():
+        # What the processor path does: full-resolution decode, resize, float normalise
+        image = Image.open(path).convert("RGB")
+        resized = np.asarray(image.resize((spec.size, spec.size), Image.BICUBIC), dtype=np.float32)
+        return (resized / 255.0 - 0.5) / 0.5
+
+    out = np.empty((3, spec.size, spec.size), dtype=np.float32)
+
+    def fast():
+        # Decodes every iteration: the decode cache would otherwise serve all but the first
+        return to_pixels(_decode_file(path, spec.size), spec, out=out)
+
+    def cache_hit():
+        # Repeat uploads (quality gate, then the Observer) skip the decode
+        return to_pixels(decode(path, spec.size), spec, out=out)
+
+    for name, fn in (("baseline", baseline), ("fast", fast), ("cache hit", cache_hit)):
+        fn()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        per_image_ms = (time.perf_counter() - started) / iterations * 1000
+        print(f"{name:>9}: {per_image_ms:.2f} ms/image")
+    print(f"Fundus box on {Image.open(path).size}: {tuple(round(v) for v in fundus_box(Image.open(path).convert('RGB')))}")
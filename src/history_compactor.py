@@ -0,0 +1,160 @@
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Incremental compaction of the interview history.
+# Instead of re-sending every Q/A pair on each loop iteration, the prompt gets
+# the last few raw turns plus a structured summary (onset, pain, vision
+# changes, ...) of the older turns, kept under a token ceiling. A turn is
+# folded into the summary only once it is no longer shown raw, so nothing is
+# sent twice. Folding uses keyword rules: no model call, and the cost per turn
+# does not grow with the length of the interview.
+
+HISTORY_RECENT_TURNS = int(os.environ.get("HISTORY_RECENT_TURNS", 2))
+HISTORY_MAX_TOKENS = int(os.environ.get("HISTORY_MAX_TOKENS", 256))
+# Snippets kept per summary field (newest win)
+MAX_SNIPPETS_PER_FIELD = 2
+MAX_SNIPPET_CHARS = 120
+
+# Summary fields in prompt order, with the keywords that route a turn to them
+SUMMARY_FIELDS = {
+    "onset": r"sudden|suddenly|gradual|gradually|started|began|onset|overnight|since|ago|yesterday|today|hours?|days?|weeks?|months?|years?",
+    "vision": r"vision|see|sight|blur|blurry|blurred|dim|distort|wavy|lines|loss|lost|dark|shadow|curtain|read",
+    "pain": r"pain|painful|hurt|hurts|ache|aching|sore|discomfort|red eye|redness",
+    "floaters_flashes": r"floater|floaters|flash|flashes|spots|cobweb|sparkle",
+    "systemic": r"diabet|sugar|glucose|insulin|blood pressure|hypertension|bp|kidney|cholesterol|pregnan",
+    "eye_history": r"surgery|operation|laser|glasses|contact lens|trauma|injury|hit|glaucoma|cataract|drops",
+    "medications": r"medication|medicine|tablet|pill|metformin|aspirin|warfarin|steroid",
+}
+FIELD_LABELS = {
+    "onset": "Onset/duration",
+    "vision": "Vision changes",
+    "pain": "Pain/redness",
+    "floaters_flashes": "Floaters/flashes",
+    "systemic": "Systemic conditions",
+    "eye_history": "Eye history",
+    "medications": "Medications",
+    "other": "Other answers",
+}
+
+_FIELD_RES = {field: re.compile(rf"\b(?:{pattern})", re.IGNORECASE) for field, pattern in SUMMARY_FIELDS.items()}
+_CLAUSE_RE = re.compile(r"(?<=[.;!?])\s+|,\s+(?:and|but)\s+")
+_YES_NO_RE = re.compile(r"^(?:yes|no|yeah|nope|not really|never)\b", re.IGNORECASE)
+
+
+def _approx_tokens(text):
+    # ~1.3 tokens per word for Gemma-style tokenizers on English text
+    return int(len(text.split()) * 1.3) + 1
+
+
+def new_summary():
+    return {field: [] for field in FIELD_LABELS}
+
+
+def _add(summary, field, snippet):
+    snippets = [s for s in summary[field] if s != snippet]
+    snippets.append(snippet)
+    summary[field] = snippets[-MAX_SNIPPETS_PER_FIELD:]
+
+
+def update_summary(summary, question, answer):
+    """
+    Folds one Q/A turn into the summary and returns the new summary.
+    Answer clauses are routed by their own keywords; an answer such as
+    "Yes, for ten years" or one without keywords is also filed under the
+    question's topic. Every snippet keeps the question it answers, so
+    "for ten years" never loses its subject.
+    """
+    summary = {field: list(summary.get(field, [])) for field in FIELD_LABELS}
+    answer = " ".join((answer or "").split())
+    if not answer:
+        return summary
+    topic = " ".join((question or "").split())[:60]
+
+    def snippet(text):
+        text = text[:MAX_SNIPPET_CHARS]
+        return f"{text} (asked: {topic})" if topic else text
+
+    routed = set()
+    for clause in _CLAUSE_RE.split(answer):
+        clause = clause.strip(" .;")
+        if not clause:
+            continue
+        for field, pattern in _FIELD_RES.items():
+            if pattern.search(clause):
+                _add(summary, field, snippet(clause))
+                routed.add(field)
+
+    if not routed or _YES_NO_RE.match(answer):
+        fields = [field for field, pattern in _FIELD_RES.items() if pattern.search(topic) and field not in routed]
+        for field in fields or ([] if routed else ["other"]):
+            _add(summary, field, snippet(answer))
+    return summary
+
+
+def render_summary(summary, newest_only=False):
+    lines = [f"- {FIELD_LABELS[field]}: {'; '.join(summary[field][-1:] if newest_only else summary[field])}"
+             for field in FIELD_LABELS if summary.get(field)]
+    return "Patient-reported so far:\n" + "\n".join(lines) if lines else ""
+
+
+def _render(summary, recent_turns, max_tokens, count_tokens):
+    summary_text = render_summary(summary)
+    if summary_text and count_tokens(summary_text) > max_tokens:
+        # Over the ceiling: newest snippet per field, then a hard cut
+        summary_text = render_summary(summary, newest_only=True)
+        words = summary_text.split(" ")
+        while len(words) > 1 and count_tokens(" ".join(words)) > max_tokens:
+            words = words[:-max(1, len(words) // 10)]
+        summary_text = " ".join(words)
+    budget = max_tokens - (count_tokens(summary_text) if summary_text else 0)
+
+    kept = []
+    for turn in reversed(recent_turns):
+        cost = count_tokens(turn)
+        # The newest turn is always kept when there is no summary to fall back on
+        if cost > budget and (kept or summary_text):
+            break
+        kept.append(turn)
+        budget -= cost
+    kept.reverse()
+
+    parts = [summary_text] if summary_text else []
+    if kept:
+        parts.append("Most recent answers:\n" + "\n".join(kept))
+    return "\n\n".join(parts), len(kept)
+
+
+def render_history(summary, recent_turns, max_tokens=HISTORY_MAX_TOKENS, count_tokens=_approx_tokens):
+    """
+    History section for a prompt: the structured summary followed by the newest
+    raw turns that still fit under max_tokens (oldest dropped first).
+    """
+    return _render(summary, recent_turns, max_tokens, count_tokens)[0]
+
+
+def _format_turn(question, answer):
+    return f"Q: {question}\nA: {answer}"
+
+
+def compact(summary, pending, question, answer, recent=HISTORY_RECENT_TURNS,
+            max_tokens=HISTORY_MAX_TOKENS, count_tokens=_approx_tokens, format_turn=_format_turn):
+    """
+    Incremental step used per interview turn. pending holds the (question,
+    answer) turns shown raw so far, not yet in the summary. The new turn joins
+    them; the oldest are folded into the summary until at most `recent` remain
+    and all of them fit under max_tokens next to it.
+    Returns (summary, pending, history_text).
+    """
+    pending = list(pending) + [(question, answer)]
+    limit = max(recent, 0)
+    while True:
+        while len(pending) > limit:
+            summary = update_summary(summary, *pending.pop(0))
+        text, shown = _render(summary, [format_turn(q, a) for q, a in pending], max_tokens, count_tokens)
+        if shown == len(pending):
+            return summary, pending, text
+        # Turns that did not fit are summarised rather than dropped
+        limit = shown
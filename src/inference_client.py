@@ -0,0 +1,87 @@
+import os
+import json
+import urllib.request
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Client for the HTTP inference API (inference_server.py).
+# With INFERENCE_API_URL set, the Gradio UI sends its model calls here instead
+# of running the agents in its own process.
+
+INFERENCE_API_URL = os.environ.get("INFERENCE_API_URL", "").rstrip("/")
+# Generation of a referral letter on CPU can take minutes
+INFERENCE_TIMEOUT_S = float(os.environ.get("INFERENCE_TIMEOUT_S", 600))
+
+
+class InferenceAPIError(RuntimeError):
+    pass
+
+
+def enabled():
+    return bool(INFERENCE_API_URL)
+
+
+def _post(route, body, content_type):
+    request = urllib.request.Request(
+        INFERENCE_API_URL + route, data=body, method="POST", headers={"Content-Type": content_type}
+    )
+    try:
+        return urllib.request.urlopen(request, timeout=INFERENCE_TIMEOUT_S)
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read()).get("error", e.reason)
+        except ValueError:
+            message = e.reason
+        raise InferenceAPIError(f"{route} failed ({e.code}): {message}") from None
+
+
+def _post_json(route, payload):
+    with _post(route, json.dumps(payload).encode("utf-8"), "application/json") as response:
+        return json.loads(response.read())
+
+
+def _stream(route, payload):
+    """Yields the accumulated text from a chunked JSON-lines response."""
+    with _post(route, json.dumps(dict(payload, stream=True)).encode("utf-8"), "application/json") as response:
+        for line in response:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise InferenceAPIError(f"{route} failed: {chunk['error']}")
+            yield chunk["text"]
+
+
+def observe(image_path):
+    """Visual findings for an image file."""
+    with open(image_path, "rb") as f:
+        body = f.read()
+    with _post("/observe", body, "application/octet-stream") as response:
+        return json.loads(response.read())["findings"]
+
+
+def question(findings, history=None):
+    return _post_json("/question", {"findings": findings, "history": history})["question"]
+
+
+def stream_question(findings, history=None):
+    yield from _stream("/question", {"findings": findings, "history": history})
+
+
+def triage(findings, history, allow_insufficient=True):
+    return _post_json("/triage", {"findings": findings, "history": history,
+                                  "allow_insufficient": allow_insufficient})["triage_level"]
+
+
+def referral(findings, history, triage_level=None):
+    return _post_json("/referral", {"findings": findings, "history": history, "triage_level": triage_level})["referral"]
+
+
+def stream_referral(findings, history, triage_level=None):
+    yield from _stream("/referral", {"findings": findings, "history": history, "triage_level": triage_level})
+
+
+def health():
+    with urllib.request.urlopen(INFERENCE_API_URL + "/healthz", timeout=10) as response:
+        return json.loads(response.read())
@@ -0,0 +1,310 @@
+import os
+import gc
+import sys
+import json
+import time
+import signal
+import socket
+import tempfile
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Workers share the weights loaded by the parent. An idle eviction followed by
+# a reload inside a worker would replace them with a private copy, and the
+# residency reaper thread must not hold its lock when the parent forks.
+os.environ.setdefault("MODEL_IDLE_TIMEOUT_S", "0")
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import agent_registry
+agent_observer = agent_registry.lazy("observer")
+agent_investigator = agent_registry.lazy("investigator")
+agent_diagnostician = agent_registry.lazy("diagnostician")
+
+from cpu_backend import available_cpus
+
+# Pre-fork HTTP inference API for the three agents.
+#   POST /observe   image bytes                                  -> {"findings"}
+#   POST /question  {"findings", "history"?, "stream"?}          -> {"question"}
+#   POST /triage    {"findings", "history", "allow_insufficient"?} -> {"triage_level"}
+#   POST /referral  {"findings", "history", "triage_level"?, "stream"?} -> {"referral"}
+#   GET  /healthz
+# The parent loads every model, freezes the GC and forks the workers; the
+# weights are then shared copy-on-write instead of loaded once per worker.
+# All workers accept() on the one listening socket, so the kernel's accept
+# queue is the shared request queue and an idle worker takes the next request.
+# Each worker is threaded, so concurrent requests still share its micro-batcher.
+# With "stream": true the response is chunked JSON lines {"text": partial}.
+# Malformed payloads (BadRequest) get a 400, any other failure a 500; a client
+# that disconnects mid-stream stops the generation.
+
+INFERENCE_HOST = os.environ.get("INFERENCE_HOST", "0.0.0.0")
+INFERENCE_PORT = int(os.environ.get("INFERENCE_PORT", 8000))
+# 0 = one worker per two CPUs
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 0))
+INFERENCE_BACKLOG = int(os.environ.get("INFERENCE_BACKLOG", 128))
+MAX_UPLOAD_MB = float(os.environ.get("INFERENCE_MAX_UPLOAD_MB", 32))
+
+_worker_id = None
+
+
+class BadRequest(Exception):
+    """Request payload failed validation; answered with a 400."""
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/healthz":
+            self._send_json(404, {"error": "not found"})
+            return
+        self._send_json(200, {"status": "ok", "worker": _worker_id, "pid": os.getpid()})
+
+    def do_POST(self):
+        route = self.path.split("?")[0]
+        handler = {
+            "/observe": self._observe, "/question": self._question,
+            "/triage": self._triage, "/referral": self._referral
+        }.get(route)
+        if handler is None:
+            self._send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_UPLOAD_MB * 1024 * 1024:
+            # The body is left unread, so the connection cannot be reused
+            self.close_connection = True
+            self._send_json(413, {"error": f"request larger than {MAX_UPLOAD_MB:g} MB"})
+            return
+        body = self.rfile.read(length)
+        started = time.perf_counter()
+        try:
+            handler(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client gone: nothing more can be sent
+            self.close_connection = True
+            print(f"[Worker {_worker_id}] {route} client disconnected")
+        except BadRequest as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+        except Exception as e:
+            print(f"[Worker {_worker_id}] {route} failed: {e}")
+            self._send_json(500, {"error": str(e)})
+        else:
+            print(f"[Worker {_worker_id}] {route} {time.perf_counter() - started:.2f}s")
+
+    def _observe(self, body):
+        if not body:
+            raise BadRequest("empty image")
+        # The agents take paths; the findings cache keys on the file contents
+        fd, path = tempfile.mkstemp(prefix="visionlink_", suffix=".img")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            findings = agent_observer.get_visual_findings(path)
+        finally:
+            os.remove(path)
+        self._send_json(200, {"findings": findings})
+
+    def _question(self, body):
+        request = _parse_request(body, stream=bool)
+        findings, history = request["findings"], request.get("history") or None
+        if request.get("stream"):
+            self._send_stream(agent_investigator.stream_interview_question(findings, history=history))
+        else:
+            self._send_json(200, {"question": agent_investigator.generate_interview_question(findings, history=history)})
+
+    def _triage(self, body):
+        request = _parse_request(body, allow_insufficient=bool)
+        triage_level = agent_diagnostician.classify_triage(
+            request["findings"], request.get("history") or "",
+            allow_insufficient=request.get("allow_insufficient", True)
+        )
+        self._send_json(200, {"triage_level": triage_level})
+
+    def _referral(self, body):
+        request = _parse_request(body, triage_level=str, stream=bool)
+        args = (request["findings"], request.get("history") or "")
+        triage_level = request.get("triage_level")
+        if request.get("stream"):
+            self._send_stream(agent_diagnostician.stream_referral(*args, triage_level=triage_level))
+        else:
+            self._send_json(200, {"referral": agent_diagnostician.generate_referral(*args, triage_level=triage_level)})
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, chunks):
+        # Headers go out only once the first chunk exists, so errors before it still get a 500
+        chunks = iter(chunks)
+        first = next(chunks, "")
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for text in _prepend(first, chunks):
+                self._write_chunk({"text": text})
+        except (BrokenPipeError, ConnectionResetError):
+            # Closing the generator stops the generation behind it
+            chunks.close()
+            raise
+        except Exception as e:
+            # The status line is already sent; report the failure in-band
+            print(f"[Worker {_worker_id}] stream failed: {e}")
+            self._write_chunk({"error": str(e)})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, payload):
+        line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        # Requests are logged per route above
+        pass
+
+
+def _parse_request(body, **optional):
+    """
+    JSON object with a string "findings", an optional string "history" and the
+    given optional fields (name=type). Anything else raises BadRequest.
+    """
+    try:
+        request = json.loads(body)
+    except ValueError as e:
+        # JSONDecodeError and UnicodeDecodeError
+        raise BadRequest(f"invalid JSON: {e}") from None
+    if not isinstance(request, dict):
+        raise BadRequest("expected a JSON object")
+    if not isinstance(request.get("findings"), str):
+        raise BadRequest("'findings' must be a string")
+    for name, kind in dict(optional, history=str).items():
+        value = request.get(name)
+        if value is not None and not isinstance(value, kind):
+            raise BadRequest(f"'{name}' must be {'a string' if kind is str else 'a boolean'}")
+    return request
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
+
+
+class WorkerServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, sock):
+        # The socket is already bound and listening in the parent
+        super().__init__(sock.getsockname()[:2], InferenceHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+
+
+def create_socket(host=INFERENCE_HOST, port=INFERENCE_PORT, backlog=INFERENCE_BACKLOG):
+    return socket.create_server((host, port), backlog=backlog)
+
+
+def load_models():
+    """Loads every model in this (parent) process before the workers are forked."""
+    agent_registry.warm_up(load_weights=True)
+    agent_registry.print_startup_report()
+
+
+def _cuda_initialized():
+    torch = sys.modules.get("torch")
+    return torch is not None and torch.cuda.is_initialized()
+
+
+def _run_worker(worker_id, sock, threads):
+    global _worker_id
+    _worker_id = worker_id
+    # Default handlers: the parent supervises and signals the workers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        # Split the cores between workers instead of oversubscribing them
+        torch.set_num_threads(threads)
+    print(f"[Worker {worker_id}] pid {os.getpid()}, {threads} threads")
+    try:
+        WorkerServer(sock).serve_forever()
+    finally:
+        os._exit(0)
+
+
+def _fork_worker(worker_id, sock, threads):
+    pid = os.fork()
+    if pid == 0:
+        _run_worker(worker_id, sock, threads)
+    return pid
+
+
+def serve(host=INFERENCE_HOST, port=INFERENCE_PORT, workers=INFERENCE_WORKERS):
+    cpus = available_cpus()
+    workers = workers or max(1, cpus // 2)
+    sock = create_socket(host, port)
+    load_models()
+
+    if _cuda_initialized() or not hasattr(os, "fork"):
+        # A CUDA context does not survive fork(); serve from this process instead
+        print("[Server] CUDA in use or fork() unavailable: serving from a single process.")
+        print(f"[Server] Listening on {host}:{port}")
+        WorkerServer(sock).serve_forever()
+        return
+
+    # Objects that exist now are never collected; GC passes no longer write to
+    # their headers, which would otherwise un-share those pages in every worker
+    gc.collect()
+    gc.freeze()
+
+    threads = max(1, cpus // workers)
+    children = {_fork_worker(i, sock, threads): i for i in range(workers)}
+    print(f"[Server] Listening on {host}:{port} with {workers} workers")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_id = children.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+        # Re-forking from the parent shares the already loaded weights again
+        print(f"[Server] Worker {worker_id} (pid {pid}) exited with status {status}; restarting")
+        children[_fork_worker(worker_id, sock, threads)] = worker_id
+    sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-fork HTTP inference API for the VisionLink agents")
+    parser.add_argument("--host", default=INFERENCE_HOST)
+    parser.add_argument("--port", type=int, default=INFERENCE_PORT)
+    parser.add_argument("--workers", type=int, default=INFERENCE_WORKERS, help="0 = one per two CPUs")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import telemetry
+
+load_dotenv()
+
+# Model residency manager.
+# Agents register their load/unload hooks here instead of unloading after every
+# call. Models stay warm across sessions and are only evicted when the memory
+# budget needs the room (least recently used first) or they sit idle too long.
+
+# 0 disables the budget (keep everything resident)
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", 0))
+# 0 disables idle eviction
+MODEL_IDLE_TIMEOUT_S = float(os.environ.get("MODEL_IDLE_TIMEOUT_S", 1800))
+
+
+class _Entry:
+    def __init__(self, name, load_fn, unload_fn, is_loaded_fn, size_fn, estimated_mb):
+        self.name = name
+        self.load_fn = load_fn
+        self.unload_fn = unload_fn
+        self.is_loaded_fn = is_loaded_fn
+        self.size_fn = size_fn
+        self.estimated_mb = estimated_mb
+        self.size_mb = 0.0
+        self.refs = 0
+        self.last_used = 0.0
+        self.ever_loaded = False
+        self.last_load_s = None
+        # Serialises loads of this model without blocking the other models
+        self.load_lock = threading.Lock()
+
+
+class ModelResidencyManager:
+    def __init__(self, memory_budget_mb=0, idle_timeout_s=0):
+        self.memory_budget_mb = memory_budget_mb
+        self.idle_timeout_s = idle_timeout_s
+        self._entries = {}
+        # Resident models in LRU order (oldest first)
+        self._resident = OrderedDict()
+        self._lock = threading.RLock()
+        self._reaper = None
+        self._stats = {"hits": 0, "loads": 0, "reloads": 0, "evictions": 0, "idle_evictions": 0}
+
+    def register(self, name, load_fn, unload_fn, is_loaded_fn, size_fn=None, estimated_mb=0):
+        """Registers a model. size_fn() reports its real footprint in MB once loaded."""
+        with self._lock:
+            self._entries[name] = _Entry(name, load_fn, unload_fn, is_loaded_fn, size_fn, estimated_mb)
+        if self.idle_timeout_s > 0:
+            self._start_reaper()
+
+    def acquire(self, name):
+        """Makes sure the model is loaded and pins it until release()."""
+        entry = self._entries[name]
+        with entry.load_lock:
+            with self._lock:
+                self._evict_idle_locked()
+                loaded = entry.is_loaded_fn()
+                if loaded:
+                    self._stats["hits"] += 1
+                else:
+                    self._make_room_locked(entry)
+                    if entry.ever_loaded:
+                        self._stats["reloads"] += 1
+                        print(f"[Residency] Reloading {name} (was evicted).")
+                    else:
+                        self._stats["loads"] += 1
+                # Pin before loading so nothing evicts it halfway
+                entry.refs += 1
+
+            if not loaded:
+                # Loading can take minutes; other models stay usable meanwhile
+                started = time.perf_counter()
+                try:
+                    entry.load_fn()
+                except Exception:
+                    self.release(name)
+                    raise
+                entry.last_load_s = time.perf_counter() - started
+                telemetry.event("model_reload" if entry.ever_loaded else "model_load",
+                                model=name, seconds=round(entry.last_load_s, 3))
+                entry.ever_loaded = True
+
+            with self._lock:
+                if entry.is_loaded_fn():
+                    if not loaded or not entry.size_mb:
+                        entry.size_mb = self._measure(entry)
+                    self._resident[name] = entry
+                    self._resident.move_to_end(name)
+                entry.last_used = time.monotonic()
+
+    def release(self, name):
+        with self._lock:
+            entry = self._entries[name]
+            entry.refs = max(0, entry.refs - 1)
+            entry.last_used = time.monotonic()
+
+    @contextmanager
+    def use(self, name):
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def evict(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.refs == 0:
+                self._evict_locked(entry)
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle_locked()
+
+    def resident_mb(self):
+        with self._lock:
+            return sum(entry.size_mb for entry in self._resident.values())
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["resident"] = {name: round(entry.size_mb, 1) for name, entry in self._resident.items()}
+            snapshot["resident_mb"] = round(sum(entry.size_mb for entry in self._resident.values()), 1)
+            snapshot["memory_budget_mb"] = self.memory_budget_mb
+            snapshot["load_seconds"] = {
+                name: round(entry.last_load_s, 3)
+                for name, entry in self._entries.items() if entry.last_load_s is not None
+            }
+            return snapshot
+
+    def _measure(self, entry):
+        if entry.size_fn is not None:
+            try:
+                size = entry.size_fn()
+                if size:
+                    return float(size)
+            except Exception as e:
+                print(f"[Residency] Could not measure {entry.name}: {e}")
+        return float(entry.estimated_mb)
+
+    def _make_room_locked(self, entry):
+        if self.memory_budget_mb <= 0:
+            return
+        needed = entry.size_mb or entry.estimated_mb
+        for name in list(self._resident.keys()):
+            used = sum(e.size_mb for e in self._resident.values())
+            if used + needed <= self.memory_budget_mb:
+                break
+            victim = self._resident[name]
+            if victim.refs == 0 and victim is not entry:
+                print(f"[Residency] Evicting {name} to fit {entry.name} in {self.memory_budget_mb:.0f}MB budget.")
+                self._evict_locked(victim, reason="budget")
+
+    def _evict_idle_locked(self):
+        if self.idle_timeout_s <= 0:
+            return
+        now = time.monotonic()
+        for entry in list(self._resident.values()):
+            if entry.refs == 0 and now - entry.last_used > self.idle_timeout_s:
+                print(f"[Residency] Evicting {entry.name} after {self.idle_timeout_s:.0f}s idle.")
+                self._evict_locked(entry, reason="idle")
+                self._stats["idle_evictions"] += 1
+
+    def _evict_locked(self, entry, reason="manual"):
+        if entry.is_loaded_fn():
+            entry.unload_fn()
+        self._resident.pop(entry.name, None)
+        self._stats["evictions"] += 1
+        telemetry.event("model_unload", model=entry.name, reason=reason, size_mb=round(entry.size_mb, 1))
+
+    def _start_reaper(self):
+        if self._reaper is not None:
+            return
+        interval = max(1.0, self.idle_timeout_s / 4)
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target=reap, name="model-residency-reaper", daemon=True)
+        self._reaper.start()
+
+
+# Shared instance that every agent registers with
+residency = ModelResidencyManager(
+    memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+    idle_timeout_s=MODEL_IDLE_TIMEOUT_S
+)
@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import operator
 from dotenv import load_dotenv
 load_dotenv()
@@ -9,15 +10,23 @@ from typing import Annotated, List, TypedDict, Union
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # Import Agents
-# Lazy import or direct import? Direct import is fine as we need them for the graph.
-# Note: Importing agents loads models. Expect startup time.
-try:
-    import agent_observer
-    import agent_investigator
-    import agent_diagnostician
-except ImportError as e:
-    print(f"Error importing agents: {e}")
-    sys.exit(1)
+# Agents are imported on first use and their models load on first call,
+# so building the graph is cheap (see agent_registry.py).
+import agent_registry
+agent_observer = agent_registry.lazy("observer")
+agent_investigator = agent_registry.lazy("investigator")
+agent_diagnostician = agent_registry.lazy("diagnostician")
+
+from model_residency import residency
+import history_compactor
+import quality_gate
+import telemetry
+
+# Per-session budgets for the interview loop; when one runs out the
+# diagnostician is forced to decide between RED, YELLOW and GREEN
+MAX_ITERATIONS = int(os.environ.get("SESSION_MAX_ITERATIONS", 5))
+MAX_TOKENS = int(os.environ.get("SESSION_MAX_TOKENS", 2048))
+MAX_WALL_S = float(os.environ.get("SESSION_MAX_WALL_S", 900))
 
 # Try importing LangGraph
 try:
@@ -29,34 +38,66 @@ except ImportError:
 # --- State Definition ---
 class AgentState(TypedDict):
     image_path: str
+    quality: dict # quality_gate.assess() report: status ok/flag/reject, reasons, metrics
     visual_findings: str
     history_log: Annotated[List[str], operator.add]
+    history_summary: dict # Structured summary of the turns no longer shown raw (history_compactor.py)
+    history_pending: list # (question, answer) turns shown raw, not yet in the summary
+    history_context: str # Summary + last turns under a token ceiling; what the prompts see
     last_question: str
     referral_report: str
-    status: str # "CONTINUE" or "FINISHED"
+    triage_level: str # RED / YELLOW / GREEN / INSUFFICIENT
+    triage_scores: dict # Per-level logits behind triage_level ({} if it was generated); reused by forced_decision
+    status: str # "CONTINUE", "BUDGET_EXCEEDED", "REJECTED" or "FINISHED"
+    iterations: int # Completed investigator -> diagnostician rounds
+    tokens_used: int # Tokens generated inside the interview loop
+    started_at: float # time.time() when the session started
+    budget_exceeded: str # "iterations" / "tokens" / "wall_time", or "" if none tripped
 
 # --- Node Definitions ---
 
+@telemetry.traced("quality_gate")
+def quality_gate_node(state: AgentState):
+    print("\n--- Node 0: Image Quality Gate ---")
+    if not quality_gate.QUALITY_GATE_ENABLED:
+        return {"quality": {"status": "ok", "reasons": [], "metrics": {}}}
+    report = quality_gate.assess(state["image_path"])
+    print(f"Image quality: {report['status']} ({report['elapsed_ms']} ms) {quality_gate.format_reasons(report)}")
+    telemetry.increment("quality_gate_total", status=report["status"])
+    if report["status"] == "reject":
+        # Unusable capture: stop before any model is loaded
+        return {
+            "quality": report,
+            "status": "REJECTED",
+            "referral_report": f"Image rejected: {quality_gate.format_reasons(report)}. Please retake the photograph."
+        }
+    return {"quality": report}
+
+@telemetry.traced("observer")
 def observer_node(state: AgentState):
     print("\n--- Node 1: Observer (Agent A) ---")
     image_path = state["image_path"]
     print(f"Anaylzing image: {image_path}")
     findings = agent_observer.get_visual_findings(image_path)
     print(f"Visual Findings: {findings}")
-    agent_observer.unload_model()
+    # The model stays resident; model_residency evicts it under memory pressure or when idle
     return {"visual_findings": findings}
 
+@telemetry.traced("investigator")
 def investigator_node(state: AgentState):
     print("\n--- Node 2: Investigator (Agent B) ---")
     findings = state["visual_findings"]
-    # Format history for Agent B
-    # History log is a list of strings "Q: ... A: ..."
-    history_str = "\n".join(state["history_log"]) if state["history_log"] else None
+    # Compacted history (summary + last turns) instead of the whole log
+    history_str = state["history_context"] or None
     
     question = agent_investigator.generate_interview_question(findings, history=history_str)
     print(f"Generated Question: {question}")
-    return {"last_question": question}
+    return {
+        "last_question": question,
+        "tokens_used": state["tokens_used"] + agent_investigator.count_tokens(question)
+    }
 
+@telemetry.traced("interaction")
 def interaction_node(state: AgentState):
     print("\n--- Node 3: Interaction ---")
     question = state["last_question"]
@@ -66,63 +107,171 @@ def interaction_node(state: AgentState):
     user_answer = input("Patient Answer: ")
     
     # Record the Q&A pair
-    new_history_entry = f"Q: {question}\nA: {user_answer}"
-    return {"history_log": [new_history_entry]}
+    return record_answer(state, question, user_answer)
+
+def format_history_entry(question, answer):
+    return f"Q: {question}\nA: {answer}"
 
+def record_answer(state, question, answer):
+    """State update for one answered question: log entry plus the incrementally compacted history."""
+    entry = format_history_entry(question, answer)
+    summary, pending, context = history_compactor.compact(
+        state["history_summary"], state["history_pending"], question, answer,
+        count_tokens=agent_investigator.count_tokens, format_turn=format_history_entry
+    )
+    return {"history_log": [entry], "history_summary": summary, "history_pending": pending,
+            "history_context": context}
+
+@telemetry.traced("diagnostician")
 def diagnostician_node(state: AgentState):
     print("\n--- Node 4: Synthesize/Check (Agent C) ---")
     findings = state["visual_findings"]
-    history_str = "\n".join(state["history_log"])
+    history_str = state["history_context"]
     
-    referral = agent_diagnostician.generate_referral(findings, history_str)
+    # Cheap structured decision; the full letter is only written once the loop ends
+    triage_level, scores = agent_diagnostician.classify_triage_with_scores(findings, history_str)
+    update = {
+        "triage_level": triage_level,
+        "triage_scores": scores or {},
+        "iterations": state["iterations"] + 1,
+        # The decision is a single level token
+        "tokens_used": state["tokens_used"] + 1
+    }
     
-    print(f"Agent C Thoughts: {referral}")
+    print(f"Agent C Triage: {triage_level}")
     
     # Check condition
-    if "INSUFFICIENT_INFO" in referral or "insufficient info" in referral.lower():
-        print("Decision: Not enough info. Looping back...")
-        return {"status": "CONTINUE", "referral_report": referral}
-    else:
+    if triage_level != "INSUFFICIENT":
         print("Decision: Diagnosis/Referral Ready.")
-        agent_investigator.unload_model()
-        return {"status": "FINISHED", "referral_report": referral}
+        return {**update, "status": "FINISHED"}
+
+    budget = exceeded_budget({**state, **update})
+    if budget:
+        print(f"Decision: Session {budget} budget exhausted. Forcing a decision...")
+        return {**update, "status": "BUDGET_EXCEEDED", "budget_exceeded": budget}
+    print("Decision: Not enough info. Looping back...")
+    return {**update, "status": "CONTINUE"}
+
+def exceeded_budget(state):
+    """Name of the first session budget that has run out, or None."""
+    if MAX_ITERATIONS > 0 and state["iterations"] >= MAX_ITERATIONS:
+        return "iterations"
+    if MAX_TOKENS > 0 and state["tokens_used"] >= MAX_TOKENS:
+        return "tokens"
+    if MAX_WALL_S > 0 and time.time() - state["started_at"] >= MAX_WALL_S:
+        return "wall_time"
+    return None
+
+@telemetry.traced("forced_decision")
+def forced_decision_node(state: AgentState):
+    print("\n--- Node 4b: Forced Decision (Agent C) ---")
+    # Decided from the last classification's scores: no further model call
+    triage_level = agent_diagnostician.forced_triage(state["triage_level"], state["triage_scores"])
+    telemetry.event("budget_exceeded", budget=state["budget_exceeded"], iterations=state["iterations"],
+                    tokens_used=state["tokens_used"])
+    print(f"Agent C Forced Triage: {triage_level} ({state['budget_exceeded']} budget exhausted)")
+    return {"status": "FINISHED", "triage_level": triage_level}
+
+@telemetry.traced("referral")
+def referral_node(state: AgentState):
+    print("\n--- Node 5: Referral Letter (Agent C) ---")
+    findings = state["visual_findings"]
+    # The letter is written once, so it gets the complete interview
+    history_str = "\n".join(state["history_log"])
+    
+    referral = agent_diagnostician.generate_referral(findings, history_str, triage_level=state["triage_level"])
+    if state["quality"].get("status") == "flag":
+        referral += f"\n\nNote: image quality warning ({quality_gate.format_reasons(state['quality'])})."
+    if state["budget_exceeded"]:
+        referral += (f"\n\nNote: the interview was stopped after the session {state['budget_exceeded']} "
+                     "budget ran out; the triage level was decided on incomplete history.")
+    return {"referral_report": referral}
 
 # --- Graph Construction ---
 
-def create_graph():
+def check_quality(state):
+    return "reject" if state["status"] == "REJECTED" else "pass"
+
+def check_diagnosis(state):
+    if state["status"] == "FINISHED":
+        return "end"
+    elif state["status"] == "BUDGET_EXCEEDED":
+        return "forced"
+    else:
+        return "loop"
+
+def build_workflow(nodes):
+    """
+    Wires the triage graph from a {name: node function} mapping.
+    Used by create_graph() and by the async runner (async_orchestrator.py).
+    """
     workflow = StateGraph(AgentState)
 
     # Add Nodes
-    workflow.add_node("observer", observer_node)
-    workflow.add_node("investigator", investigator_node)
-    workflow.add_node("interaction", interaction_node)
-    workflow.add_node("diagnostician", diagnostician_node)
+    for name, node in nodes.items():
+        workflow.add_node(name, node)
 
     # Set Entry Point
-    workflow.set_entry_point("observer")
+    workflow.set_entry_point("quality_gate")
 
     # Add Edges
+    workflow.add_conditional_edges(
+        "quality_gate",
+        check_quality,
+        {
+            "pass": "observer",
+            "reject": END
+        }
+    )
     workflow.add_edge("observer", "investigator")
     workflow.add_edge("investigator", "interaction")
     workflow.add_edge("interaction", "diagnostician")
+    workflow.add_edge("forced_decision", "referral")
+    workflow.add_edge("referral", END)
 
     # Conditional Logic
-    def check_diagnosis(state):
-        if state["status"] == "FINISHED":
-            return "end"
-        else:
-            return "loop"
-
     workflow.add_conditional_edges(
         "diagnostician",
         check_diagnosis,
         {
-            "end": END,
+            "end": "referral",
+            "forced": "forced_decision",
             "loop": "investigator"
         }
     )
 
-    return workflow.compile()
+    return workflow
+
+def create_graph():
+    return build_workflow({
+        "quality_gate": quality_gate_node,
+        "observer": observer_node,
+        "investigator": investigator_node,
+        "interaction": interaction_node,
+        "diagnostician": diagnostician_node,
+        "forced_decision": forced_decision_node,
+        "referral": referral_node,
+    }).compile()
+
+def initial_state(image_path):
+    return {
+        "image_path": image_path,
+        "quality": {},
+        "visual_findings": "",
+        "history_log": [],
+        "history_summary": history_compactor.new_summary(),
+        "history_pending": [],
+        "history_context": "",
+        "last_question": "",
+        "referral_report": "",
+        "triage_level": "",
+        "triage_scores": {},
+        "status": "START",
+        "iterations": 0,
+        "tokens_used": 0,
+        "started_at": time.time(),
+        "budget_exceeded": ""
+    }
 
 # --- Main Execution ---
 
@@ -148,23 +297,25 @@ if __name__ == "__main__":
 
     print(f"Starting VisionLink Orchestration with Image: {target_image}")
     
+    telemetry.start_metrics_server()
     app = create_graph()
     
-    # Initial State
-    initial_state = {
-        "image_path": target_image,
-        "visual_findings": "",
-        "history_log": [],
-        "last_question": "",
-        "referral_report": "",
-        "status": "START"
-    }
-
     # Run the graph
     # Depending on langgraph version, output might supply the final state
     try:
-        final_state = app.invoke(initial_state)
-        print("\n\n=== FINAL REFERRAL REPORT ===")
+        final_state = app.invoke(initial_state(target_image))
+        if final_state["status"] == "REJECTED":
+            print(f"\n\n=== {final_state['referral_report']} ===")
+            sys.exit(1)
+        print(f"\n\n=== FINAL REFERRAL REPORT ({final_state['triage_level']}) ===")
+        if final_state["budget_exceeded"]:
+            print(f"(Forced decision: {final_state['budget_exceeded']} budget exhausted)")
         print(final_state["referral_report"])
+        print(f"\nModel residency: {residency.stats()}")
+        print(f"Prefix KV cache: {agent_investigator.get_prefix_cache_stats()}")
+        if agent_investigator.get_speculative_stats():
+            print(f"Speculative decoding: {agent_investigator.get_speculative_stats()}")
+        print(f"Observer backend: {agent_observer.get_backend_stats()}")
+        agent_registry.print_startup_report()
     except Exception as e:
         print(f"Error during execution: {e}")
@@ -0,0 +1,154 @@
+import os
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+import telemetry
+
+load_dotenv()
+
+# Prompt-prefix KV cache for the shared MedGemma model.
+# Agent B and Agent C resend the same instruction block on every call, and the
+# same visual findings on every loop iteration. We keep the past key/values of
+# those prefixes and only prefill the part of the prompt that is new.
+#
+# Opt-in (PREFIX_CACHE_ENABLED=1). A cached call is a single-sequence forward
+# outside the micro-batcher, and cached calls run one at a time on the shared
+# model. That cuts prefill latency for a lone session, but under concurrent
+# load the batcher's shared forward passes give more throughput, so the cache
+# is off by default.
+
+PREFIX_CACHE_ENABLED = os.environ.get("PREFIX_CACHE_ENABLED", "0") == "1"
+PREFIX_CACHE_MAX_ENTRIES = int(os.environ.get("PREFIX_CACHE_MAX_ENTRIES", 16))
+
+
+class PrefixKVCache:
+    def __init__(self, max_entries=PREFIX_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # key -> (prefix length in tokens, past key/values), LRU order
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Serialises the model calls; _lock only guards the entries and stats
+        self._model_lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "prefill_tokens": 0,
+            "prefill_tokens_saved": 0,
+        }
+
+    def generate(self, model, tokenizer, prompt_text, prefix_texts, **gen_kwargs):
+        """
+        Generates a continuation of prompt_text. prefix_texts are increasingly
+        long prefixes of prompt_text whose KV caches are worth keeping.
+        Returns only the newly generated text.
+        """
+        import torch
+
+        input_ids = self._tokenize(tokenizer, prompt_text).to(model.device)
+        attention_mask = torch.ones_like(input_ids)
+        with self._model_lock:
+            past, cached_len = self._prepare(model, tokenizer, input_ids, prefix_texts)
+            with torch.no_grad():
+                output = model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    past_key_values=past,
+                    **gen_kwargs
+                )
+        return tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+    def next_token_logits(self, model, tokenizer, prompt_text, prefix_texts):
+        """Logits for the token following prompt_text, reusing cached prefixes."""
+        import torch
+
+        input_ids = self._tokenize(tokenizer, prompt_text).to(model.device)
+        with self._model_lock:
+            past, cached_len = self._prepare(model, tokenizer, input_ids, prefix_texts)
+            with torch.no_grad():
+                outputs = model(input_ids=input_ids[:, cached_len:], past_key_values=past, use_cache=True)
+        return outputs.logits[0, -1]
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["entries"] = len(self._entries)
+        total = snapshot["prefill_tokens"] + snapshot["prefill_tokens_saved"]
+        snapshot["prefill_saved_ratio"] = snapshot["prefill_tokens_saved"] / total if total else 0.0
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _tokenize(self, tokenizer, text):
+        # Chat-templated text already carries <bos>
+        return tokenizer(text, return_tensors="pt", add_special_tokens=False).input_ids
+
+    def _prepare(self, model, tokenizer, input_ids, prefix_texts):
+        """
+        Returns (past key/values covering the longest usable prefix, its length).
+        Missing prefix levels are computed incrementally and stored.
+        """
+        import torch
+        from transformers import DynamicCache
+
+        full = input_ids[0].tolist()
+        # Only prefixes that tokenize to an exact prefix of the full prompt can be reused
+        boundaries = []
+        for text in prefix_texts:
+            ids = self._tokenize(tokenizer, text)[0].tolist()
+            if 0 < len(ids) < len(full) and full[:len(ids)] == ids:
+                boundaries.append(len(ids))
+        boundaries = sorted(set(boundaries))
+
+        past, cached_len = None, 0
+        with self._lock:
+            for length in reversed(boundaries):
+                key = self._key(full[:length])
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    cached_len, stored = self._entries[key]
+                    past = copy.deepcopy(stored)
+                    self._stats["hits"] += 1
+                    telemetry.increment("cache_lookups_total", cache="prefix_kv", result="hit")
+                    break
+            else:
+                if boundaries:
+                    self._stats["misses"] += 1
+                    telemetry.increment("cache_lookups_total", cache="prefix_kv", result="miss")
+
+        if past is None:
+            past = DynamicCache()
+        hit_len = cached_len
+
+        # Extend level by level so each new prefix is stored for the next call
+        for length in boundaries:
+            if length <= cached_len:
+                continue
+            with torch.no_grad():
+                outputs = model(input_ids=input_ids[:, cached_len:length], past_key_values=past, use_cache=True)
+            past = outputs.past_key_values
+            with self._lock:
+                self._stats["prefill_tokens"] += length - cached_len
+                self._store_locked(self._key(full[:length]), length, copy.deepcopy(past))
+            cached_len = length
+
+        with self._lock:
+            self._stats["prefill_tokens"] += len(full) - cached_len
+            self._stats["prefill_tokens_saved"] += hit_len
+        telemetry.increment("prefill_tokens_saved_total", hit_len)
+        return past, cached_len
+
+    def _store_locked(self, key, length, past):
+        self._entries[key] = (length, past)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _key(self, ids):
+        return hashlib.sha1(repr(ids).encode()).hexdigest()
+
+
+prefix_cache = PrefixKVCache()
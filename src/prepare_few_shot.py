@@ -1,53 +1,96 @@
 import pandas as pd
+import numpy as np
 import os
 import json
+import time
 
 # Define paths
 base_path = r'd:\Users\axeld\MCIT\VisionLink\VisionLink'
 csv_path = os.path.join(base_path, 'archive', 'full_df.csv')
 image_dir = os.path.join(base_path, 'archive', 'preprocessed_images')
+output_path = os.path.join(base_path, 'few_shot_examples.json')
 
-def prepare_few_shot():
+# We want a few examples for different labels: N (Normal), D (Diabetic Retinopathy), G (Glaucoma), C (Cataract), A (Age-related Macular Degeneration), H (Hypertension), M (Myopia), O (Others)
+LABELS = ['N', 'D', 'G', 'C', 'A', 'H', 'M', 'O']
+EXAMPLES_PER_LABEL = 3
+# Rows per chunk, so CSVs larger than RAM can be streamed
+CHUNK_SIZE = 50000
+
+COLUMNS = ['filename', 'labels', 'Left-Diagnostic Keywords', 'Right-Diagnostic Keywords']
+
+def labels_to_multi_hot(labels_column, labels=LABELS):
+    """
+    Parses the 'labels' column (e.g. "['N']" or "['D', 'H']") into a boolean
+    multi-hot frame with one column per label, in a single vectorised pass.
+    """
+    codes = labels_column.fillna('').str.replace(r"[\[\]'\"\s]", "", regex=True)
+    dummies = codes.str.get_dummies(sep=',')
+    return dummies.reindex(columns=labels, fill_value=0).astype(bool)
+
+def scan_images(directory):
+    """One directory scan instead of an os.path.exists call per candidate."""
+    if not os.path.isdir(directory):
+        return set()
+    with os.scandir(directory) as entries:
+        return {entry.name for entry in entries if entry.is_file()}
+
+def prepare_few_shot(csv_path=csv_path, image_dir=image_dir, output_path=output_path,
+                     k=EXAMPLES_PER_LABEL, chunksize=CHUNK_SIZE):
     if not os.path.exists(csv_path):
         print(f"CSV not found at {csv_path}")
         return
 
-    df = pd.read_csv(csv_path)
-    
-    # We want a few examples for different labels: N (Normal), D (Diabetic Retinopathy), G (Glaucoma), C (Cataract), A (Age-related Macular Degeneration), H (Hypertension), M (Myopia), O (Others)
-    labels = ['N', 'D', 'G', 'C', 'A', 'H', 'M', 'O']
-    few_shot_examples = {}
-
-    for label in labels:
-        # Filter for rows that have this label in the 'labels' column
-        # The 'labels' column looks like "['N']" or "['D', 'H']"
-        mask = df['labels'].apply(lambda x: label in eval(x))
-        sample = df[mask].head(3) # Take top 3 for each
-        
-        examples = []
-        for _, row in sample.iterrows():
-            # Determine if it's left or right eye from the 'filename' or 'filepath'
-            # Looking at the CSV sample, 'filename' is like '0_right.jpg'
-            is_right = '_right' in row['filename']
-            keywords = row['Right-Diagnostic Keywords'] if is_right else row['Left-Diagnostic Keywords']
-            
-            # Check if image exists
-            img_path = os.path.join(image_dir, row['filename'])
-            if os.path.exists(img_path):
-                examples.append({
-                    "image_path": img_path,
+    start = time.perf_counter()
+    available = scan_images(image_dir)
+    few_shot_examples = {label: [] for label in LABELS}
+    rows_read = 0
+
+    for chunk in pd.read_csv(csv_path, usecols=COLUMNS, chunksize=chunksize):
+        rows_read += len(chunk)
+        multi_hot = labels_to_multi_hot(chunk['labels'])
+        filenames = chunk['filename'].astype(str)
+        exists = filenames.isin(available).to_numpy()
+
+        # Determine if it's left or right eye from the 'filename', e.g. '0_right.jpg'
+        is_right = filenames.str.contains('_right', regex=False).to_numpy()
+        keywords = np.where(is_right, chunk['Right-Diagnostic Keywords'], chunk['Left-Diagnostic Keywords'])
+        filenames = filenames.to_numpy()
+
+        for label in LABELS:
+            needed = k - len(few_shot_examples[label])
+            if needed <= 0:
+                continue
+            rows = np.flatnonzero(multi_hot[label].to_numpy() & exists)[:needed]
+            few_shot_examples[label].extend(
+                {
+                    "image_path": os.path.join(image_dir, filenames[i]),
                     "label": label,
-                    "keywords": keywords
-                })
-        
-        few_shot_examples[label] = examples
+                    "keywords": keywords[i]
+                }
+                for i in rows
+            )
+
+        # Stop reading as soon as every label has its k examples
+        if all(len(examples) >= k for examples in few_shot_examples.values()):
+            break
 
     # Output to a json file
-    output_path = os.path.join(base_path, 'few_shot_examples.json')
     with open(output_path, 'w') as f:
         json.dump(few_shot_examples, f, indent=4)
-    
+
+    elapsed = time.perf_counter() - start
+    print(f"Scanned {rows_read} rows in {elapsed:.2f}s.")
     print(f"Few-shot examples saved to {output_path}")
+    return few_shot_examples
 
 if __name__ == "__main__":
-    prepare_few_shot()
+    import argparse
+    parser = argparse.ArgumentParser(description="Build few-shot exemplars from the ODIR CSV")
+    parser.add_argument("--csv", default=csv_path)
+    parser.add_argument("--images", default=image_dir)
+    parser.add_argument("--output", default=output_path)
+    parser.add_argument("-k", type=int, default=EXAMPLES_PER_LABEL, help="Examples per label")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    prepare_few_shot(args.csv, args.images, args.output, args.k, args.chunksize)
@@ -0,0 +1,169 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from fundus_preprocess import decode, BORDER_THRESHOLD
+
+# Pre-inference image quality gate.
+# A few vectorised NumPy metrics on a ~256px copy of the upload decide whether
+# a capture is usable before any model is loaded. The upload is decoded at the
+# Observer's draft scale and kept (fundus_preprocess.decode), so the gate costs
+# the Observer no second decode. Masks and maxima stay in uint8; only the grey
+# image for the Laplacian is float.
+#   coverage   share of the frame covered by the bright fundus disc, how well
+#              it fills a circle and how much lies outside that circle
+#              (rectangular, non-fundus photos fail this)
+#   exposure   mean brightness, dark and saturated pixel fractions in the disc
+#   sharpness  variance of the Laplacian inside the disc (blur)
+#   colour     fundus images are red-dominant
+# "reject" stops the session with a reason, "flag" lets it continue with a warning.
+
+QUALITY_GATE_ENABLED = os.environ.get("QUALITY_GATE_ENABLED", "1") == "1"
+ANALYSIS_SIZE = 256
+
+MIN_COVERAGE = float(os.environ.get("QUALITY_MIN_COVERAGE", 0.15))
+MIN_CIRCLE_FILL = 0.6
+MAX_OUTSIDE_CIRCLE = 0.08
+MIN_BRIGHTNESS = 25.0
+MAX_BRIGHTNESS = 220.0
+MAX_DARK_FRACTION = 0.5
+MAX_SATURATED_FRACTION = 0.2
+# Laplacian variance on the 256px grey copy; vessels in a focused capture score well above this
+MIN_SHARPNESS = float(os.environ.get("QUALITY_MIN_SHARPNESS", 40.0))
+# Below this the image is unusable rather than merely soft
+REJECT_SHARPNESS = MIN_SHARPNESS / 4
+
+
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def _analysis_image(image_or_path):
+    # Same decode the Observer asks for, so it is served from the decode cache there
+    image = decode(image_or_path) if isinstance(image_or_path, str) else image_or_path.convert("RGB")
+    if max(image.size) > ANALYSIS_SIZE:
+        # The decoded image is shared: thumbnail a copy
+        image = image.copy()
+        image.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE), Image.BILINEAR, reducing_gap=1.0)
+    return np.asarray(image)
+
+
+def _erode(mask, iterations):
+    for _ in range(iterations):
+        inner = np.zeros_like(mask)
+        inner[1:-1, 1:-1] = mask[1:-1, 1:-1] & mask[:-2, 1:-1] & mask[2:, 1:-1] & mask[1:-1, :-2] & mask[1:-1, 2:]
+        mask = inner
+    return mask
+
+
+def laplacian_variance(gray, mask=None):
+    """Variance of the 4-neighbour Laplacian (interior pixels, optionally masked)."""
+    lap = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]) - 4 * gray[1:-1, 1:-1]
+    if mask is not None:
+        # Stay clear of the disc edge: the border step would read as sharpness
+        lap = lap[_erode(mask, 3)[1:-1, 1:-1]]
+    return float(lap.var()) if lap.size else 0.0
+
+
+def measure(image_or_path):
+    """Raw quality metrics of an image or image path."""
+    rgb = _analysis_image(image_or_path)
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    # Per-channel maximum of uint8 planes: much cheaper than max(axis=2)
+    peak = np.maximum(np.maximum(red, green), blue)
+    mask = peak > BORDER_THRESHOLD
+    area = int(np.count_nonzero(mask))
+    coverage = area / mask.size
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    circle_fill, outside_circle = 0.0, 1.0
+    if rows.size and cols.size:
+        diameter = max(rows[-1] - rows[0] + 1, cols[-1] - cols[0] + 1)
+        # Area of the disc relative to the circle spanning its bounding box
+        circle_fill = float(area / (np.pi * (diameter / 2) ** 2))
+        # Share of the bright region outside that circle (the corners of a plain photo)
+        cy, cx = (rows[0] + rows[-1]) / 2, (cols[0] + cols[-1]) / 2
+        yy, xx = np.ogrid[:mask.shape[0], :mask.shape[1]]
+        circle = (yy - cy) ** 2 + (xx - cx) ** 2 <= (diameter / 2 + 1) ** 2
+        outside_circle = float(np.count_nonzero(mask & ~circle) / area)
+
+    region = mask if area else np.ones_like(mask)
+    gray = rgb @ _LUMA
+    luminance = gray[region]
+    means = [float(channel.mean(where=region)) for channel in (red, green, blue)]
+    return {
+        "coverage": round(coverage, 4),
+        "circle_fill": round(circle_fill, 4),
+        "outside_circle": round(outside_circle, 4),
+        "brightness": round(float(luminance.mean()), 2),
+        "dark_fraction": round(float(np.count_nonzero(luminance < 30) / luminance.size), 4),
+        "saturated_fraction": round(float(np.count_nonzero(peak[region] > 250) / luminance.size), 4),
+        "sharpness": round(laplacian_variance(gray, mask), 3),
+        "red_dominance": round(means[0] / (means[1] + means[2] + 1e-6), 3),
+    }
+
+
+def assess(image_or_path):
+    """
+    Returns {"status": "ok" | "flag" | "reject", "reasons": [...], "metrics": {...}, "elapsed_ms"}.
+    Unreadable files are rejected with the error as the reason.
+    """
+    started = time.perf_counter()
+    try:
+        metrics = measure(image_or_path)
+    except (OSError, ValueError) as e:
+        return {"status": "reject", "reasons": [f"Image could not be read ({e})"], "metrics": {},
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+    rejects, flags = [], []
+    if (metrics["coverage"] < MIN_COVERAGE or metrics["circle_fill"] < MIN_CIRCLE_FILL * 0.5
+            or metrics["outside_circle"] > MAX_OUTSIDE_CIRCLE):
+        rejects.append("No fundus disc found (is this a retinal photograph?)")
+    elif metrics["circle_fill"] < MIN_CIRCLE_FILL:
+        flags.append("Fundus region is not circular (cropped or partially occluded capture)")
+    if metrics["red_dominance"] < 0.6:
+        rejects.append("Colours do not look like a fundus image")
+
+    if metrics["brightness"] < MIN_BRIGHTNESS or metrics["dark_fraction"] > MAX_DARK_FRACTION:
+        (rejects if metrics["brightness"] < MIN_BRIGHTNESS / 2 else flags).append("Image is underexposed")
+    if metrics["brightness"] > MAX_BRIGHTNESS or metrics["saturated_fraction"] > MAX_SATURATED_FRACTION:
+        flags.append("Image is overexposed (glare or flash reflection)")
+
+    if metrics["sharpness"] < REJECT_SHARPNESS:
+        rejects.append("Image is too blurry to assess")
+    elif metrics["sharpness"] < MIN_SHARPNESS:
+        flags.append("Image is slightly out of focus")
+
+    status = "reject" if rejects else "flag" if flags else "ok"
+    return {"status": status, "reasons": rejects + flags, "metrics": metrics,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 2)}
+
+
+def format_reasons(report):
+    return "; ".join(report["reasons"])
+
+
+if __name__ == "__main__":
+    import sys
+    from PIL import ImageFilter
+    from fundus_preprocess import _synthetic_fundus
+
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            print(path, assess(path))
+    else:
+        # Synthetic checks: a fundus, the same blurred, a dark frame and a plain photo
+        fundus = Image.open(_synthetic_fundus()).convert("RGB")
+        samples = {
+            "fundus": fundus,
+            "blurred": fundus.filter(ImageFilter.GaussianBlur(40)),
+            "dark": Image.fromarray((np.asarray(fundus) * 0.1).astype(np.uint8)),
+            "grey photo": Image.new("RGB", (800, 600), (128, 128, 128)),
+        }
+        for name, image in samples.items():
+            report = assess(image)
+            print(f"{name:>11}: {report['status']:<6} {report['elapsed_ms']:.1f}ms {format_reasons(report)}")
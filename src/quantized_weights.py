@@ -0,0 +1,325 @@
+import os
+import json
+import struct
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Pre-quantized, pre-sharded model artifacts for CPU hosts.
+# export_quantized() stores every nn.Linear / nn.Embedding weight as int8
+# (per output channel) or packed int4 (per group of INT4_GROUP_SIZE) plus fp16
+# scales in safetensors shards. load_quantized() builds the model skeleton on the
+# meta device and memory-maps the shards, so startup is page-in time rather than
+# a from_pretrained + bitsandbytes re-quantization, and weights are
+# dequantized layer by layer during the forward pass, QUANTIZED_BLOCK_MB of
+# output rows at a time: the tied lm_head (256000 x 2304 for Gemma 2) would be
+# ~2.2 GiB in float32 if dequantized whole on every decode step.
+
+QUANTIZED_MODELS_DIR = os.environ.get(
+    "QUANTIZED_MODELS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
+)
+QUANTIZED_BITS = int(os.environ.get("QUANTIZED_BITS", 8))
+# Compute dtype for dequantized weights and the remaining float tensors
+QUANTIZED_COMPUTE_DTYPE = os.environ.get("QUANTIZED_COMPUTE_DTYPE", "float32")
+# Largest dequantized weight block materialised at once per linear layer
+QUANTIZED_BLOCK_MB = float(os.environ.get("QUANTIZED_BLOCK_MB", 64))
+SHARD_SIZE_MB = 512
+INT4_GROUP_SIZE = 64
+INDEX_FILE = "quantized.index.json"
+BUFFER_PREFIX = "buffer:"
+
+# safetensors dtype -> numpy dtype used for the memory map (BF16 is viewed afterwards)
+_NUMPY_DTYPES = {
+    "F32": np.float32,
+    "F16": np.float16,
+    "BF16": np.uint16,
+    "I64": np.int64,
+    "I32": np.int32,
+    "I8": np.int8,
+    "U8": np.uint8,
+    "BOOL": np.bool_,
+}
+
+
+def artifact_dir(model_id, bits=QUANTIZED_BITS, root=QUANTIZED_MODELS_DIR):
+    return os.path.join(root, f"{model_id.split('/')[-1]}-int{bits}")
+
+
+def find_artifact(model_id, bits=QUANTIZED_BITS, root=QUANTIZED_MODELS_DIR):
+    """Directory of an exported artifact for model_id, or None."""
+    path = artifact_dir(model_id, bits, root)
+    return path if os.path.exists(os.path.join(path, INDEX_FILE)) else None
+
+
+def _compute_dtype():
+    import torch
+    return getattr(torch, QUANTIZED_COMPUTE_DTYPE)
+
+
+# --- Quantization ---
+
+def quantize_int8(weight):
+    """Symmetric per-output-channel int8. Returns (int8 [out, in], fp16 scale [out])."""
+    import torch
+    w = weight.detach().float()
+    scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    q = torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scale.to(torch.float16)
+
+
+def quantize_int4(weight, group_size=INT4_GROUP_SIZE):
+    """Symmetric group-wise int4, two values per byte. Returns (uint8 [out, in/2], fp16 scale [out, groups])."""
+    import torch
+    import torch.nn.functional as F
+    w = weight.detach().float()
+    out_features, in_features = w.shape
+    pad = (-in_features) % group_size
+    if pad:
+        w = F.pad(w, (0, pad))
+    groups = w.reshape(out_features, -1, group_size)
+    scale = groups.abs().amax(dim=2).clamp(min=1e-8) / 7.0
+    q = (torch.round(groups / scale[..., None]).clamp(-8, 7) + 8).to(torch.uint8).reshape(out_features, -1)
+    packed = q[:, 0::2] | (q[:, 1::2] << 4)
+    return packed, scale.to(torch.float16)
+
+
+def dequantize(qweight, scale, bits, in_features, dtype):
+    import torch
+    if bits == 8:
+        return qweight.to(dtype) * scale.to(dtype)[:, None]
+    # Unpack the two nibbles back into interleaved columns
+    q = torch.stack((qweight & 0x0F, qweight >> 4), dim=-1).reshape(qweight.shape[0], -1).to(dtype) - 8
+    groups = q.reshape(q.shape[0], scale.shape[1], -1) * scale.to(dtype)[..., None]
+    return groups.reshape(q.shape[0], -1)[:, :in_features]
+
+
+def _block_rows(in_features, element_size, block_mb=QUANTIZED_BLOCK_MB):
+    """Output rows per dequantized block of at most block_mb."""
+    return max(1, int(block_mb * 1024 * 1024 // (in_features * element_size)))
+
+
+def _quantize(weight, bits):
+    return quantize_int8(weight) if bits == 8 else quantize_int4(weight)
+
+
+def _make_modules():
+    import torch
+    import torch.nn.functional as F
+
+    class QuantizedLinear(torch.nn.Module):
+        def __init__(self, qweight, scale, bias, bits, in_features, out_features):
+            super().__init__()
+            self.bits = bits
+            self.in_features = in_features
+            self.out_features = out_features
+            self.register_buffer("qweight", qweight)
+            self.register_buffer("scale", scale)
+            self.bias = torch.nn.Parameter(bias, requires_grad=False) if bias is not None else None
+
+        def forward(self, x):
+            bias = self.bias.to(x.dtype) if self.bias is not None else None
+            rows = _block_rows(self.in_features, x.element_size())
+            if rows >= self.out_features:
+                weight = dequantize(self.qweight, self.scale, self.bits, self.in_features, x.dtype)
+                return F.linear(x, weight, bias)
+            # Large layers: dequantize and multiply one block of output rows at a time
+            out = x.new_empty(*x.shape[:-1], self.out_features)
+            for start in range(0, self.out_features, rows):
+                end = min(start + rows, self.out_features)
+                weight = dequantize(self.qweight[start:end], self.scale[start:end], self.bits, self.in_features, x.dtype)
+                out[..., start:end] = F.linear(x, weight, bias[start:end] if bias is not None else None)
+            return out
+
+    class QuantizedEmbedding(torch.nn.Module):
+        def __init__(self, qweight, scale, bits, num_embeddings, embedding_dim, padding_idx):
+            super().__init__()
+            self.bits = bits
+            self.num_embeddings = num_embeddings
+            self.embedding_dim = embedding_dim
+            self.padding_idx = padding_idx
+            self.register_buffer("qweight", qweight)
+            self.register_buffer("scale", scale)
+
+        def forward(self, input_ids):
+            # Only the looked-up rows are dequantized
+            flat = input_ids.reshape(-1)
+            rows = dequantize(self.qweight[flat], self.scale[flat], self.bits, self.embedding_dim, _compute_dtype())
+            return rows.reshape(*input_ids.shape, self.embedding_dim)
+
+    return QuantizedLinear, QuantizedEmbedding
+
+
+# --- Export ---
+
+def export_quantized(model, out_dir, bits=QUANTIZED_BITS, shard_size_mb=SHARD_SIZE_MB):
+    """Writes a quantized, sharded safetensors artifact for a loaded HF model."""
+    import torch
+    from safetensors.torch import save_file
+
+    if bits not in (4, 8):
+        raise ValueError("bits must be 4 or 8")
+    os.makedirs(out_dir, exist_ok=True)
+
+    tensors = {}
+    layout = {"bits": bits, "modules": {}, "tied": {}}
+    owners = {}
+
+    for name, module in model.named_modules():
+        # Exact types only: subclasses may override forward (e.g. scaled embeddings)
+        if type(module) not in (torch.nn.Linear, torch.nn.Embedding):
+            continue
+        pointer = module.weight.data_ptr()
+        if pointer in owners:
+            # Tied weights (e.g. lm_head <-> embed_tokens) are stored once
+            layout["tied"][name] = owners[pointer]
+            continue
+        owners[pointer] = name
+
+        qweight, scale = _quantize(module.weight, bits)
+        tensors[f"{name}.qweight"] = qweight
+        tensors[f"{name}.scale"] = scale
+        if type(module) is torch.nn.Linear:
+            layout["modules"][name] = {
+                "kind": "linear", "in_features": module.in_features, "out_features": module.out_features
+            }
+            if module.bias is not None:
+                tensors[f"{name}.bias"] = module.bias.detach().float()
+        else:
+            layout["modules"][name] = {
+                "kind": "embedding", "num_embeddings": module.num_embeddings,
+                "embedding_dim": module.embedding_dim, "padding_idx": module.padding_idx
+            }
+
+    replaced = set(layout["modules"]) | set(layout["tied"])
+    for name, param in model.named_parameters():
+        if name.rsplit(".", 1)[0] not in replaced:
+            tensors[name] = param.detach().float()
+    # Buffers too (including non-persistent ones such as rotary inv_freq): the
+    # skeleton is built on the meta device and has no values for them
+    for name, buffer in model.named_buffers():
+        if name.rsplit(".", 1)[0] not in replaced:
+            tensors[BUFFER_PREFIX + name] = buffer.detach().float() if buffer.is_floating_point() else buffer.detach()
+
+    weight_map = {}
+    shard, shard_bytes, shards = {}, 0, []
+    for name, tensor in tensors.items():
+        size = tensor.numel() * tensor.element_size()
+        if shard and shard_bytes + size > shard_size_mb * 1024 * 1024:
+            shards.append(shard)
+            shard, shard_bytes = {}, 0
+        shard[name] = tensor.contiguous().cpu()
+        shard_bytes += size
+    if shard:
+        shards.append(shard)
+
+    for i, shard in enumerate(shards):
+        filename = f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+        save_file(shard, os.path.join(out_dir, filename))
+        for name in shard:
+            weight_map[name] = filename
+
+    with open(os.path.join(out_dir, INDEX_FILE), "w") as f:
+        json.dump({"layout": layout, "weight_map": weight_map}, f, indent=2)
+    model.config.save_pretrained(out_dir)
+    if getattr(model, "generation_config", None) is not None:
+        model.generation_config.save_pretrained(out_dir)
+
+    total_mb = sum(t.numel() * t.element_size() for t in tensors.values()) / (1024 * 1024)
+    print(f"Exported int{bits} artifact ({total_mb:.0f}MB in {len(shards)} shards) to {out_dir}")
+
+
+# --- Loading ---
+
+def mmap_safetensors(path):
+    """
+    Maps a safetensors file and returns its tensors as views on the mapping.
+    Pages are only read when touched and stay shared with the page cache
+    (copy-on-write), so several processes can map the same artifact.
+    """
+    import torch
+
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+    data_start = 8 + header_len
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+
+    tensors = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        array = buffer[data_start + start:data_start + end].view(_NUMPY_DTYPES[info["dtype"]]).reshape(info["shape"])
+        tensor = torch.from_numpy(array)
+        if info["dtype"] == "BF16":
+            tensor = tensor.view(torch.bfloat16)
+        tensors[name] = tensor
+    return tensors
+
+
+def _set_submodule(model, name, module):
+    parent_name, _, child = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, child, module)
+
+
+def load_quantized(model_cls, path):
+    """Builds model_cls from an exported artifact with memory-mapped weights."""
+    import torch
+    from transformers import AutoConfig, GenerationConfig
+
+    QuantizedLinear, QuantizedEmbedding = _make_modules()
+    dtype = _compute_dtype()
+
+    with open(os.path.join(path, INDEX_FILE), "r") as f:
+        index = json.load(f)
+    layout = index["layout"]
+    bits = layout["bits"]
+
+    tensors = {}
+    for filename in sorted(set(index["weight_map"].values())):
+        tensors.update(mmap_safetensors(os.path.join(path, filename)))
+
+    config = AutoConfig.from_pretrained(path)
+    with torch.device("meta"):
+        model = model_cls._from_config(config)
+
+    quantized = {}
+    for name, spec in layout["modules"].items():
+        qweight, scale = tensors.pop(f"{name}.qweight"), tensors.pop(f"{name}.scale")
+        if spec["kind"] == "linear":
+            bias = tensors.pop(f"{name}.bias", None)
+            module = QuantizedLinear(qweight, scale, bias, bits, spec["in_features"], spec["out_features"])
+        else:
+            module = QuantizedEmbedding(qweight, scale, bits, spec["num_embeddings"], spec["embedding_dim"], spec["padding_idx"])
+        quantized[name] = (module, spec)
+        _set_submodule(model, name, module)
+
+    for name, owner in layout["tied"].items():
+        module, spec = quantized[owner]
+        if spec["kind"] == "embedding":
+            # lm_head tied to the embedding matrix: same buffers, linear forward
+            module = QuantizedLinear(module.qweight, module.scale, None, bits, spec["embedding_dim"], spec["num_embeddings"])
+        _set_submodule(model, name, module)
+
+    state = {}
+    for name, tensor in tensors.items():
+        if name.startswith(BUFFER_PREFIX):
+            module_name, _, buffer_name = name[len(BUFFER_PREFIX):].rpartition(".")
+            owner = model.get_submodule(module_name) if module_name else model
+            value = tensor.to(dtype) if tensor.is_floating_point() else tensor
+            # Writing into _buffers keeps the persistent/non-persistent flag
+            owner._buffers[buffer_name] = value
+        else:
+            state[name] = tensor.to(dtype) if tensor.is_floating_point() else tensor
+    model.load_state_dict(state, strict=False, assign=True)
+
+    missing = [n for n, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if missing:
+        raise RuntimeError(f"Quantized artifact at {path} is missing tensors: {missing[:5]}")
+
+    if os.path.exists(os.path.join(path, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(path)
+    model.eval()
+    return model
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import queue
+import sqlite3
+import hashlib
+import atexit
+import threading
+import time
+from dotenv import load_dotenv
+import telemetry
+
+load_dotenv()
+
+# Persistent store for completed triage reports.
+# The request path only puts the report on an in-memory queue; a background
+# writer drains it and inserts up to REPORT_STORE_BATCH_SIZE rows per
+# transaction into SQLite (WAL mode, so reads never wait for the writer).
+# Queries are keyset-paginated on (created_at, id) over the (created_at) and
+# (triage_level, created_at) indexes (SQLite appends the rowid to every index
+# entry): "newest N" is an index range scan whatever the table size, and rows
+# sharing a timestamp are never skipped between pages.
+
+REPORT_STORE_ENABLED = os.environ.get("REPORT_STORE_ENABLED", "1") == "1"
+REPORT_STORE_PATH = os.environ.get(
+    "REPORT_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "triage_reports.sqlite")
+)
+REPORT_STORE_BATCH_SIZE = int(os.environ.get("REPORT_STORE_BATCH_SIZE", 256))
+# Longest a queued report waits for more to share its transaction
+REPORT_STORE_FLUSH_MS = float(os.environ.get("REPORT_STORE_FLUSH_MS", 200))
+# Reports beyond this many pending writes are dropped (and counted) instead of blocking a request
+REPORT_STORE_QUEUE_SIZE = int(os.environ.get("REPORT_STORE_QUEUE_SIZE", 10000))
+
+COLUMNS = ("created_at", "session_id", "image_hash", "triage_level", "findings", "history", "report", "source")
+
+_STOP = object()
+
+
+def cursor(row):
+    """Keyset cursor of a returned row: pass it as before= to get the next page."""
+    return (row["created_at"], row["id"])
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 of a file's bytes."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ReportStore:
+    def __init__(self, path=REPORT_STORE_PATH, batch_size=REPORT_STORE_BATCH_SIZE,
+                 flush_ms=REPORT_STORE_FLUSH_MS, queue_size=REPORT_STORE_QUEUE_SIZE):
+        self.path = os.path.abspath(path)
+        self.batch_size = batch_size
+        self.flush_s = flush_ms / 1000.0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # Writer connection, used only by the writer thread after setup
+        self._write_conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._write_conn.execute("PRAGMA journal_mode=WAL")
+        self._write_conn.execute("PRAGMA synchronous=NORMAL")
+        self._write_conn.execute(
+            """CREATE TABLE IF NOT EXISTS reports (
+                id INTEGER PRIMARY KEY,
+                created_at REAL NOT NULL,
+                session_id TEXT,
+                image_hash TEXT,
+                triage_level TEXT NOT NULL,
+                findings TEXT,
+                history TEXT,
+                report TEXT,
+                source TEXT
+            )"""
+        )
+        self._write_conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports(created_at)")
+        self._write_conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_reports_level_created_at ON reports(triage_level, created_at)"
+        )
+        self._write_conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_image_hash ON reports(image_hash)")
+        self._write_conn.commit()
+
+        self._read_conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._read_conn.row_factory = sqlite3.Row
+        self._read_lock = threading.Lock()
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stats_lock = threading.Lock()
+        self._stats = {"queued": 0, "written": 0, "dropped": 0, "batches": 0, "write_errors": 0}
+        self._writer = threading.Thread(target=self._write_loop, name="report-writer", daemon=True)
+        self._writer.start()
+
+    def submit(self, triage_level, findings, report, history="", image_hash=None, session_id=None,
+               source="gradio", created_at=None):
+        """Queues a finished report for writing. Never blocks; returns False if it had to be dropped."""
+        row = (created_at or time.time(), session_id, image_hash, triage_level, findings, history, report, source)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["dropped"] += 1
+                dropped = self._stats["dropped"]
+            if dropped == 1 or dropped % 1000 == 0:
+                print(f"WARNING: Report store queue is full; {dropped} reports dropped so far.")
+            return False
+        with self._stats_lock:
+            self._stats["queued"] += 1
+        return True
+
+    def _write_loop(self):
+        while True:
+            row = self._queue.get()
+            if row is _STOP:
+                self._queue.task_done()
+                return
+            rows = [row]
+            stop = False
+            deadline = time.monotonic() + self.flush_s
+            # Collect more rows until the batch is full or the flush window closes
+            while len(rows) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    row = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    stop = True
+                    break
+                rows.append(row)
+            self._write(rows)
+            for _ in range(len(rows) + stop):
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, rows):
+        started = time.perf_counter()
+        try:
+            with self._write_conn:
+                self._write_conn.executemany(
+                    f"INSERT INTO reports ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows
+                )
+        except sqlite3.Error as e:
+            print(f"WARNING: Could not write {len(rows)} reports ({e}).")
+            with self._stats_lock:
+                self._stats["write_errors"] += len(rows)
+            return
+        with self._stats_lock:
+            self._stats["written"] += len(rows)
+            self._stats["batches"] += 1
+        telemetry.observe("report_store_write_seconds", time.perf_counter() - started)
+        telemetry.increment("reports_written_total", len(rows))
+
+    def flush(self):
+        """Blocks until every queued report is on disk."""
+        self._queue.join()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        self._write_conn.close()
+        self._read_conn.close()
+
+    def _query(self, where, params, limit, before):
+        if before is not None:
+            where.append("(created_at, id) < (?, ?)")
+            params.extend(before)
+        sql = "SELECT * FROM reports"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        with self._read_lock:
+            rows = self._read_conn.execute(sql, params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def recent(self, limit=50, before=None):
+        """Newest reports first. before=cursor(last row of the previous page) continues from there."""
+        return self._query([], [], limit, before)
+
+    def by_level(self, triage_level, limit=50, before=None, since=None):
+        where, params = ["triage_level = ?"], [triage_level]
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        return self._query(where, params, limit, before)
+
+    def red_cases(self, limit=50, before=None, since=None):
+        """Newest RED (emergency) reports first."""
+        return self.by_level("RED", limit, before, since)
+
+    def by_image(self, image_hash, limit=50, before=None):
+        """Earlier reports for the same image (re-uploads, second opinions)."""
+        return self._query(["image_hash = ?"], [image_hash], limit, before)
+
+    def stats(self):
+        with self._stats_lock:
+            snapshot = dict(self._stats)
+        snapshot["pending"] = self._queue.qsize()
+        return snapshot
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Shared store instance, or None when disabled via REPORT_STORE_ENABLED=0."""
+    global _store
+    if not REPORT_STORE_ENABLED:
+        return None
+    with _store_lock:
+        if _store is None:
+            try:
+                _store = ReportStore()
+            except sqlite3.Error as e:
+                print(f"WARNING: Report store unavailable ({e}). Reports will not be persisted.")
+                return None
+            # Write whatever is still queued on a normal exit
+            atexit.register(_store.close)
+        return _store
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Query the triage report store")
+    parser.add_argument("query", choices=["recent", "red", "image", "stats"])
+    parser.add_argument("image_hash", nargs="?", help="For the image query")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--before", default=None,
+                        help="Cursor 'created_at,id' of the last row of the previous page (printed after each page)")
+    args = parser.parse_args()
+
+    before = tuple(float(v) if i == 0 else int(v) for i, v in enumerate(args.before.split(","))) if args.before else None
+    store = ReportStore()
+    if args.query == "stats":
+        with store._read_lock:
+            counts = store._read_conn.execute(
+                "SELECT triage_level, COUNT(*) FROM reports GROUP BY triage_level"
+            ).fetchall()
+        print(json.dumps({level: count for level, count in counts}, indent=2))
+        sys.exit(0)
+    if args.query == "recent":
+        rows = store.recent(args.limit, before)
+    elif args.query == "red":
+        rows = store.red_cases(args.limit, before)
+    else:
+        rows = store.by_image(args.image_hash, args.limit, before)
+    for row in rows:
+        print(json.dumps(row, ensure_ascii=False))
+    if len(rows) == args.limit:
+        created_at, row_id = cursor(rows[-1])
+        print(f"Next page: --before {created_at!r},{row_id}", file=sys.stderr)
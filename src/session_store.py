@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Per-session conversation state for the Gradio UI.
+# Each browser session gets its own findings/question/history, so concurrent
+# users on one instance no longer overwrite each other. Finished reports go to
+# the persistent report store (report_store.py), not the session.
+
+SESSION_TTL_S = float(os.environ.get("SESSION_TTL_S", 3600))
+SESSION_MAX = int(os.environ.get("SESSION_MAX", 500))
+
+
+def new_session_state():
+    return {
+        "findings": None,
+        "question": None,
+        "image_hash": None
+    }
+
+
+class SessionStore:
+    def __init__(self, ttl_s=SESSION_TTL_S, max_sessions=SESSION_MAX):
+        self.ttl_s = ttl_s
+        self.max_sessions = max_sessions
+        # session_id -> (last_access, state), least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """Returns the state for session_id, creating it if needed."""
+        now = time.monotonic()
+        with self._lock:
+            self._cleanup_locked(now)
+            entry = self._sessions.pop(session_id, None)
+            state = entry[1] if entry is not None else new_session_state()
+            self._sessions[session_id] = (now, state)
+            # Bound the memory footprint: drop the least recently used sessions
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return state
+
+    def reset(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def cleanup(self):
+        with self._lock:
+            return self._cleanup_locked(time.monotonic())
+
+    def _cleanup_locked(self, now):
+        # Entries are ordered by last access, so expired ones are at the front
+        removed = 0
+        while self._sessions:
+            session_id, (last_access, _) = next(iter(self._sessions.items()))
+            if now - last_access <= self.ttl_s:
+                break
+            self._sessions.popitem(last=False)
+            removed += 1
+        return removed
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
@@ -0,0 +1,145 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from quantized_weights import find_artifact, load_quantized
+
+# Assisted (speculative) decoding for the shared Investigator/Diagnostician model.
+# A small draft model proposes a few tokens per step and the main model checks
+# them all in one forward pass, so long outputs (questions, referral letters)
+# need far fewer main-model forwards. Greedy output is the same as with plain
+# decoding. Opt-in: set DRAFT_MODEL_ID. A draft with a different tokenizer is
+# used through universal assisted decoding (slower, but still works).
+#
+# Acceptance is measured with forward hooks: each main-model forward in
+# assisted generation yields its accepted draft tokens plus one of its own, so
+#   accepted = new_tokens - main_forwards,  drafted = draft_forwards
+# (prefix-cache prefill forwards make `accepted` a slight underestimate).
+# The hooks count per thread, so concurrent sessions run their assisted calls
+# side by side and each call still sees only its own forwards.
+
+# Empty disables speculative decoding
+DRAFT_MODEL_ID = os.environ.get("DRAFT_MODEL_ID", "")
+# Assisted generation runs one sequence at a time; short outputs (the triage
+# label) stay on the micro-batcher
+SPECULATIVE_MIN_NEW_TOKENS = int(os.environ.get("SPECULATIVE_MIN_NEW_TOKENS", 32))
+# Initial draft length per step; transformers adapts it to the acceptance rate
+NUM_ASSISTANT_TOKENS = int(os.environ.get("SPECULATIVE_NUM_ASSISTANT_TOKENS", 5))
+
+
+class ForwardCounter:
+    """Counts forward calls of a model made by the calling thread."""
+
+    def __init__(self, model):
+        self._local = threading.local()
+        self._handle = model.register_forward_hook(self._hook)
+
+    @property
+    def calls(self):
+        return getattr(self._local, "calls", 0)
+
+    def _hook(self, module, inputs, output):
+        self._local.calls = self.calls + 1
+
+    def remove(self):
+        self._handle.remove()
+
+
+class SpeculativeDecoder:
+    """Draft model plus the bookkeeping for acceptance rate and tokens/sec."""
+
+    def __init__(self, model, tokenizer, draft_model, draft_tokenizer):
+        self.tokenizer = tokenizer
+        self.draft_model = draft_model
+        self.draft_tokenizer = draft_tokenizer
+        self.same_tokenizer = draft_tokenizer.get_vocab() == tokenizer.get_vocab()
+        draft_model.generation_config.num_assistant_tokens = NUM_ASSISTANT_TOKENS
+        self._main_counter = ForwardCounter(model)
+        self._draft_counter = ForwardCounter(draft_model)
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "new_tokens": 0, "seconds": 0.0, "drafted": 0, "accepted": 0,
+                       "main_forwards": 0}
+
+    def generate_kwargs(self):
+        kwargs = {"assistant_model": self.draft_model}
+        if not self.same_tokenizer:
+            kwargs.update(tokenizer=self.tokenizer, assistant_tokenizer=self.draft_tokenizer)
+        return kwargs
+
+    def run(self, generate):
+        """
+        Calls generate(assistant kwargs) -> text and records the call's
+        acceptance and throughput. A None result is passed through uncounted.
+        """
+        main_before, draft_before = self._main_counter.calls, self._draft_counter.calls
+        started = time.perf_counter()
+        text = generate(self.generate_kwargs())
+        if text is None:
+            return None
+        elapsed = time.perf_counter() - started
+        main_forwards = self._main_counter.calls - main_before
+        drafted = self._draft_counter.calls - draft_before
+        new_tokens = len(self.tokenizer.encode(text, add_special_tokens=False))
+        accepted = min(max(0, new_tokens - main_forwards), drafted)
+        with self._lock:
+            stats = self._stats
+            stats["calls"] += 1
+            stats["new_tokens"] += new_tokens
+            stats["seconds"] += elapsed
+            stats["drafted"] += drafted
+            stats["accepted"] += accepted
+            stats["main_forwards"] += main_forwards
+        rate = accepted / drafted if drafted else 0.0
+        print(f"[Speculative] {new_tokens} tokens in {elapsed:.2f}s "
+              f"({new_tokens / elapsed if elapsed > 0 else 0.0:.1f} tok/s), acceptance {rate:.0%}")
+        return text
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["draft_model"] = getattr(self.draft_model.config, "_name_or_path", DRAFT_MODEL_ID)
+        stats["acceptance_rate"] = stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0
+        stats["tokens_per_s"] = stats["new_tokens"] / stats["seconds"] if stats["seconds"] else 0.0
+        # Tokens per main-model forward; 1.0 is plain decoding
+        stats["tokens_per_forward"] = stats["new_tokens"] / stats["main_forwards"] if stats["main_forwards"] else 0.0
+        return stats
+
+    def footprint_mb(self):
+        return self.draft_model.get_memory_footprint() / (1024 * 1024)
+
+    def close(self):
+        self._main_counter.remove()
+        self._draft_counter.remove()
+
+
+def load_draft(model, tokenizer, draft_model_id=DRAFT_MODEL_ID):
+    """
+    Loads the draft model next to model (same device and dtype; the
+    pre-quantized artifact on CPU when there is one). Returns a
+    SpeculativeDecoder, or None when no draft is configured or it fails to load.
+    """
+    if not draft_model_id:
+        return None
+    try:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        artifact = find_artifact(draft_model_id)
+        if artifact and model.device.type == "cpu":
+            draft_model = load_quantized(AutoModelForCausalLM, artifact)
+            draft_tokenizer = AutoTokenizer.from_pretrained(artifact)
+        else:
+            # bnb-quantized main models report bfloat16 compute; the draft is small enough unquantized
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_id, dtype=model.dtype, low_cpu_mem_usage=True
+            ).to(model.device)
+            draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_id)
+        draft_model.eval()
+        decoder = SpeculativeDecoder(model, tokenizer, draft_model, draft_tokenizer)
+        mode = "shared tokenizer" if decoder.same_tokenizer else "universal assisted decoding"
+        print(f"Speculative decoding enabled with draft model {draft_model_id} ({mode}).")
+        return decoder
+    except Exception as e:
+        print(f"WARNING: Draft model {draft_model_id} unavailable ({e}). Using plain decoding.")
+        return None
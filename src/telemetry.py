@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import threading
+import functools
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Structured instrumentation for the triage workflow.
+# @traced wraps graph nodes and pipeline calls (wall time, errors, attributes
+# such as token counts), increment() counts cache hits and the like, and
+# event() records model load/unload/eviction. Metrics are served in the
+# Prometheus text format on /metrics and spans/events are appended to a
+# JSON-lines trace file.
+# Disabled by default: @traced then returns the function unchanged and the
+# other calls return after a single flag check.
+
+TELEMETRY_ENABLED = os.environ.get("TELEMETRY_ENABLED", "0") == "1"
+# 0 disables the /metrics endpoint
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# Empty disables the trace file
+TRACE_PATH = os.environ.get("TRACE_PATH", "")
+
+METRIC_PREFIX = "visionlink_"
+# Latency histogram buckets in seconds (model calls range from ms to minutes)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_local = threading.local()
+_trace_file = None
+_server = None
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def increment(metric, value=1, **labels):
+    """Adds value to counter metric{labels}."""
+    if not TELEMETRY_ENABLED:
+        return
+    key = (metric, _label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(metric, value, **labels):
+    """Records value in histogram metric{labels}."""
+    if not TELEMETRY_ENABLED:
+        return
+    key = (metric, _label_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def event(event_name, **fields):
+    """Counts and traces a discrete event (model load, eviction, ...)."""
+    if not TELEMETRY_ENABLED:
+        return
+    increment("events_total", event=event_name)
+    _write_trace({"type": "event", "name": event_name, **fields})
+
+
+def annotate(**attrs):
+    """Attaches attributes (e.g. prompt_tokens) to the innermost active span on this thread."""
+    if not TELEMETRY_ENABLED:
+        return
+    stack = getattr(_local, "spans", None)
+    if stack:
+        stack[-1].update(attrs)
+
+
+def traced(name, kind="node"):
+    """
+    Decorator recording wall time, errors and annotate()d attributes of each call.
+    Nodes appear as visionlink_node_duration_seconds{name=...}, pipeline calls
+    as visionlink_pipeline_duration_seconds{name=...}.
+    """
+    def decorator(fn):
+        if not TELEMETRY_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            stack = getattr(_local, "spans", None)
+            if stack is None:
+                stack = _local.spans = []
+            attrs = {}
+            stack.append(attrs)
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                stack.pop()
+                observe(f"{kind}_duration_seconds", elapsed, name=name)
+                increment(f"{kind}_calls_total", name=name, status=status)
+                for attr, value in attrs.items():
+                    if attr.endswith("_tokens") and isinstance(value, (int, float)):
+                        increment(f"{kind}_{attr}_total", value, name=name)
+                _write_trace({
+                    "type": "span", "kind": kind, "name": name,
+                    "duration_s": round(elapsed, 6), "status": status,
+                    "thread": threading.current_thread().name, **attrs
+                })
+        return wrapper
+    return decorator
+
+
+def _write_trace(record):
+    global _trace_file
+    if not TRACE_PATH:
+        return
+    record = {"ts": round(time.time(), 6), **record}
+    line = json.dumps(record, default=str) + "\n"
+    with _lock:
+        if _trace_file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(TRACE_PATH)), exist_ok=True)
+            # Line buffered: every record reaches the file without an explicit flush
+            _trace_file = open(TRACE_PATH, "a", buffering=1, encoding="utf-8")
+        _trace_file.write(line)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def render_metrics():
+    """Prometheus text exposition of every counter and histogram."""
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: dict(value, buckets=list(value["buckets"])) for key, value in _histograms.items()}
+
+    seen = set()
+    for (name, labels), value in sorted(counters.items()):
+        metric = METRIC_PREFIX + name
+        if metric not in seen:
+            lines.append(f"# TYPE {metric} counter")
+            seen.add(metric)
+        lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        metric = METRIC_PREFIX + name
+        if metric not in seen:
+            lines.append(f"# TYPE {metric} histogram")
+            seen.add(metric)
+        for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+        lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serves /metrics on a daemon thread. No-op when disabled or port is 0."""
+    global _server
+    if not TELEMETRY_ENABLED or not port or _server is not None:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Keep scrapes out of the console log
+            pass
+
+    _server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"[Telemetry] Serving metrics on :{port}/metrics")
+    return _server
@@ -0,0 +1,152 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import agent_registry
+agent_observer = agent_registry.lazy("observer")
+agent_investigator = agent_registry.lazy("investigator")
+
+# Staged first-turn pipeline: preprocess -> observe -> question.
+# Decode/resize/normalize runs on a CPU worker pool, PaliGemma generation on a
+# single dedicated inference worker, and question generation starts as soon as
+# an image's findings are ready. Bounded queues between the stages give
+# backpressure, so under sustained load image N+1 is preprocessed while image N
+# is being generated.
+
+PREPROCESS_WORKERS = int(os.environ.get("PIPELINE_PREPROCESS_WORKERS", 2))
+QUESTION_WORKERS = int(os.environ.get("PIPELINE_QUESTION_WORKERS", 2))
+QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 8))
+
+
+class TriageJob:
+    """Handle for one submitted image. Findings resolve before the question."""
+
+    def __init__(self, image_path, with_question):
+        self.image_path = image_path
+        self.with_question = with_question
+        self.findings = Future()
+        self.question = Future()
+        self.prepared = None
+        self.timings = {}
+        self.submitted_at = time.perf_counter()
+
+
+class _StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.queue_wait_s = 0.0
+
+    def record(self, elapsed, waited):
+        self.count += 1
+        self.total_s += elapsed
+        self.max_s = max(self.max_s, elapsed)
+        self.queue_wait_s += waited
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean_s": self.total_s / self.count if self.count else 0.0,
+            "max_s": self.max_s,
+            "mean_queue_wait_s": self.queue_wait_s / self.count if self.count else 0.0,
+        }
+
+
+class TriagePipeline:
+    def __init__(self, preprocess_workers=PREPROCESS_WORKERS, question_workers=QUESTION_WORKERS,
+                 queue_size=QUEUE_SIZE):
+        self._preprocess_pool = ThreadPoolExecutor(max_workers=preprocess_workers, thread_name_prefix="preprocess")
+        # Bounded hand-off queues between stages
+        self._inference_queue = queue.Queue(maxsize=queue_size)
+        self._question_queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._stats = {"preprocess": _StageStats(), "observe": _StageStats(), "question": _StageStats()}
+
+        self._threads = [threading.Thread(target=self._inference_loop, name="observer-inference", daemon=True)]
+        for i in range(question_workers):
+            # Several question workers so concurrent prompts can share a micro-batch
+            self._threads.append(threading.Thread(target=self._question_loop, name=f"question-{i}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, image_path, with_question=True):
+        """Queues an image. Returns a TriageJob whose futures resolve per stage."""
+        job = TriageJob(image_path, with_question)
+        self._preprocess_pool.submit(self._preprocess, job)
+        return job
+
+    def stats(self):
+        with self._lock:
+            stages = {name: stage.as_dict() for name, stage in self._stats.items()}
+        stages["inference_queue_depth"] = self._inference_queue.qsize()
+        stages["question_queue_depth"] = self._question_queue.qsize()
+        return stages
+
+    def _record(self, stage, job, started, enqueued_at):
+        elapsed = time.perf_counter() - started
+        job.timings[stage] = elapsed
+        with self._lock:
+            self._stats[stage].record(elapsed, started - enqueued_at)
+
+    def _preprocess(self, job):
+        started = time.perf_counter()
+        try:
+            job.prepared = agent_observer.preprocess_image(job.image_path)
+        except Exception as e:
+            self._fail(job, e)
+            return
+        self._record("preprocess", job, started, job.submitted_at)
+        # Blocks when the inference worker is behind (backpressure)
+        self._inference_queue.put((job, time.perf_counter()))
+
+    def _inference_loop(self):
+        while True:
+            job, enqueued_at = self._inference_queue.get()
+            started = time.perf_counter()
+            try:
+                findings = agent_observer.generate_findings(job.prepared)
+            except Exception as e:
+                self._fail(job, e)
+                continue
+            job.prepared = None
+            self._record("observe", job, started, enqueued_at)
+            job.findings.set_result(findings)
+            if job.with_question:
+                self._question_queue.put((job, findings, time.perf_counter()))
+
+    def _question_loop(self):
+        while True:
+            job, findings, enqueued_at = self._question_queue.get()
+            started = time.perf_counter()
+            try:
+                question = agent_investigator.generate_interview_question(findings)
+            except Exception as e:
+                job.question.set_exception(e)
+                continue
+            self._record("question", job, started, enqueued_at)
+            job.question.set_result(question)
+
+    def _fail(self, job, error):
+        if not job.findings.done():
+            job.findings.set_exception(error)
+        if not job.question.done():
+            job.question.set_exception(error)
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline():
+    """Shared pipeline instance (workers start on first use)."""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = TriagePipeline()
+    return _pipeline
@@ -1,48 +1,99 @@
 import gradio as gr
 import os
-from agent_observer import get_visual_findings
-from agent_investigator import generate_interview_question
-from agent_diagnostician import generate_referral
+import agent_registry
+from triage_pipeline import get_pipeline
+from session_store import SessionStore
+import inference_client
+import quality_gate
+import report_store
+import telemetry
 
-# Global state to track conversation
-conversation_state = {
-    "findings": None,
-    "question": None,
-    "history": []
-}
+# Agents import lazily; weights load on first use or during background warm-up.
+# With INFERENCE_API_URL set no model is loaded here: the model calls go to the
+# inference server (inference_server.py) instead.
+agent_investigator = agent_registry.lazy("investigator")
+agent_diagnostician = agent_registry.lazy("diagnostician")
 
-def process_first_turn(image):
-    """First turn: Agent A (Observer) -> Agent B (Investigator)"""
-    global conversation_state
+# Conversation state per browser session (TTL-based cleanup, bounded size)
+sessions = SessionStore()
+
+# Concurrent runs per event handler. Gradio defaults to 1, which would serialise
+# every session; keep this equal to Cloud Run containerConcurrency (deploy.ps1)
+GRADIO_CONCURRENCY = int(os.environ.get("GRADIO_CONCURRENCY", 80))
+
+def _session_id(request):
+    # Gradio assigns every browser tab its own session hash
+    if request is None:
+        return "default"
+    return request.session_hash
+
+def process_first_turn(image, request: gr.Request):
+    """First turn: Agent A (Observer) -> Agent B (Investigator), streamed"""
+    # A new scan starts a new case: nothing from the previous upload may carry
+    # over, even if this one is rejected or fails before it is stored
+    sessions.reset(_session_id(request))
+    conversation_state = sessions.get(_session_id(request))
     
     if image is None:
-        return "⚠️ Please upload a retinal scan to start the triage process.", "", ""
+        yield "⚠️ Please upload a retinal scan to start the triage process.", "", ""
+        return
+    
+    # Cheap quality check first, so unusable captures never reach the models
+    warning = ""
+    if quality_gate.QUALITY_GATE_ENABLED:
+        quality = quality_gate.assess(image)
+        print(f"[Quality Gate] {quality['status']} ({quality['elapsed_ms']} ms) {quality_gate.format_reasons(quality)}")
+        if quality["status"] == "reject":
+            yield f"⚠️ Image rejected: {quality_gate.format_reasons(quality)}. Please retake the photograph.", "", ""
+            return
+        if quality["status"] == "flag":
+            warning = f"⚠️ Image quality: {quality_gate.format_reasons(quality)}. Findings may be less reliable.\n\n"
     
     print(f"[Agent A] Processing image...")
-    findings = get_visual_findings(image)  # Agent A
+    if inference_client.enabled():
+        findings = inference_client.observe(image)  # Agent A
+    else:
+        # Preprocessing overlaps with other sessions' generation in the staged pipeline;
+        # the question is streamed below rather than generated by the pipeline
+        job = get_pipeline().submit(image, with_question=False)
+        findings = job.findings.result()  # Agent A
+        print(f"[Agent A] Stage timings: {job.timings}")
     
     print(f"[Agent A] Findings: {findings}")
+    # Show the findings straight away while the question is generated
+    yield warning + findings, "", ""
     print(f"[Agent B] Generating interview question...")
     
-    question = generate_interview_question(findings)  # Agent B
+    question = ""
+    stream_question = inference_client.stream_question if inference_client.enabled() else agent_investigator.stream_interview_question
+    for question in stream_question(findings):  # Agent B
+        yield warning + findings, question, ""
     
     print(f"[Agent B] Question: {question}")
     
     # Store in state
     conversation_state["findings"] = findings
     conversation_state["question"] = question
+    conversation_state["image_hash"] = report_store.file_digest(image)
     
-    return findings, question, ""
+    yield warning + findings, question, ""
 
-def process_second_turn(patient_answer):
-    """Second turn: Agent C (Diagnostician)"""
-    global conversation_state
+def process_second_turn(image, patient_answer, request: gr.Request):
+    """Second turn: Agent C (Diagnostician), streamed into the report box"""
+    conversation_state = sessions.get(_session_id(request))
     
     if not conversation_state["findings"] or not conversation_state["question"]:
-        return "⚠️ Please upload a retinal scan first."
+        yield "⚠️ Please upload a retinal scan first."
+        return
+    
+    # The findings must belong to the scan on screen, not an earlier upload
+    if image is None or report_store.file_digest(image) != conversation_state["image_hash"]:
+        yield "⚠️ This scan has not been analyzed yet. Please click \"Analyze Scan\" first."
+        return
     
     if not patient_answer or patient_answer.strip() == "":
-        return "⚠️ Please provide an answer to the question."
+        yield "⚠️ Please provide an answer to the question."
+        return
     
     print(f"[Agent C] Generating final report...")
     
@@ -50,28 +101,34 @@ def process_second_turn(patient_answer):
     findings = conversation_state["findings"]
     patient_history = f"Q: {conversation_state['question']}\nA: {patient_answer}"
     
-    report = generate_referral(findings, patient_history)  # Agent C
+    # Decide the level first (one scoring pass) so the letter and the stored case agree on it;
+    # there is no further interview turn here, so INSUFFICIENT is not an option
+    classify = inference_client.triage if inference_client.enabled() else agent_diagnostician.classify_triage
+    triage_level = classify(findings, patient_history, allow_insufficient=False)
+    print(f"[Agent C] Triage level: {triage_level}")
     
-    print(f"[Agent C] Report generated.")
+    report = ""
+    stream_referral = inference_client.stream_referral if inference_client.enabled() else agent_diagnostician.stream_referral
+    for report in stream_referral(findings, patient_history, triage_level=triage_level):  # Agent C
+        yield report
     
-    # Store in history
-    conversation_state["history"].append({
-        "findings": findings,
-        "question": conversation_state["question"],
-        "answer": patient_answer,
-        "report": report
-    })
+    print(f"[Agent C] Report generated.")
     
-    return report
+    # Persist the finished case; the background writer does the disk I/O
+    store = report_store.get_store()
+    if store is not None:
+        store.submit(
+            triage_level=triage_level,
+            findings=findings,
+            history=patient_history,
+            report=report,
+            image_hash=conversation_state["image_hash"],
+            session_id=_session_id(request)
+        )
 
-def reset_conversation():
-    """Reset the conversation state"""
-    global conversation_state
-    conversation_state = {
-        "findings": None,
-        "question": None,
-        "history": []
-    }
+def reset_conversation(request: gr.Request):
+    """Reset the conversation state for this session"""
+    sessions.reset(_session_id(request))
     return "", "", "", ""
 
 # Create the Gradio Interface
@@ -130,7 +187,7 @@ with gr.Blocks(title="🏥 VisionLink: Rural Triage Agent", theme=gr.themes.Soft
     
     generate_btn.click(
         fn=process_second_turn,
-        inputs=[patient_answer],
+        inputs=[image_input, patient_answer],
         outputs=[report_output]
     )
     
@@ -149,6 +206,9 @@ with gr.Blocks(title="🏥 VisionLink: Rural Triage Agent", theme=gr.themes.Soft
     4. Click "Generate Triage Report" to get the final diagnosis and referral
     """)
 
+# Sessions run side by side, so the micro-batcher and staged pipeline see concurrent requests
+demo.queue(default_concurrency_limit=GRADIO_CONCURRENCY)
+
 if __name__ == "__main__":
     print("=" * 60)
     print("🏥 VisionLink: Rural Triage Agent")
@@ -156,6 +216,13 @@ if __name__ == "__main__":
     print("\nStarting Gradio interface...")
     print("Upload a retinal scan to begin the triage process.\n")
     
+    telemetry.start_metrics_server()
+    if inference_client.enabled():
+        print(f"Using the inference API at {inference_client.INFERENCE_API_URL}\n")
+    elif agent_registry.WARMUP_ON_START:
+        # Bind the port right away; models load in the background
+        agent_registry.start_warmup()
+    
     try:
         demo.launch(
             share=False,